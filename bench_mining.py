@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+'''
+Mining benchmark. Compares hashes per second of the old miner loop (dumps the
+whole block to json for each nonce) and `miner.do_mine` (hashes the block
+prefix once, then only the nonce for each attempt).
+
+Usage:
+    $ python bench_mining.py [-n NUM_HASHES]
+'''
+
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+
+from Crypto.Hash import SHA384
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+from noobcash.backend import settings, state, keypair, miner
+from noobcash.backend.transaction import Transaction
+
+# parse arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', help='number of hashes for each run', type=int, default=5000)
+args = parser.parse_args()
+
+################################################################################
+
+def old_mine(transactions, nonce, count, difficulty):
+    '''the miner loop before midstate hashing'''
+    base = {}
+    base['transactions'] = transactions
+
+    for _ in range(count):
+        base['nonce'] = nonce
+        base['timestamp'] = timestamp = str(datetime.datetime.now())
+
+        base_json_string = json.dumps(base, sort_keys=True)
+        sha = SHA384.new(base_json_string.encode()).hexdigest()
+
+        if sha.startswith('0' * difficulty):
+            return nonce, sha, timestamp
+
+        nonce = (nonce + 1) % miner.MAX_NONCE
+
+    return None
+
+
+def run(name, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+
+    print(f'{name}\t{args.n / elapsed:12.0f} hashes/sec')
+    return args.n / elapsed
+
+################################################################################
+
+# a block of real transactions, signed with a 2048-bit key
+keypair.generate_keypair()
+transactions = []
+for i in range(settings.BLOCK_CAPACITY):
+    t = Transaction(sender=state.pubkey, recepient=state.pubkey, amount=i + 1, inputs=[])
+    t.sign()
+    transactions.append(t.dump_sendable())
+
+# 96 leading zeros, so that no hash is ever good enough
+before = run('before', lambda: old_mine(transactions, 0, args.n, 96))
+after = run('after', lambda: miner.do_mine(transactions, 0, args.n, miner.target_bytes(0), lambda: False))
+
+print(f'speedup\t{after / before:12.1f}x')
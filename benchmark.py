@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+'''
+Cluster benchmark. Starts a participant for each file of a workload (e.g. `inputs5`)
+on localhost, sends the transactions of each file to its participant at a fixed
+rate, waits for the chains to settle and reports, as json:
+
+    * tps               transactions in the final chain per second
+    * block_time        mean and 95th percentile of time between blocks (seconds)
+    * fork_rate         blocks mined but not in the final chain, over blocks mined
+    * consensus_runs    times a participant had to ask the others for their chain
+    * bytes_sent        bytes sent between participants: requests (broadcasts, gossip,
+                        consensus, compact block fetches) and their responses, bodies only
+
+One run for each combination of `--capacity` and `--difficulty`.
+
+Usage:
+    $ python benchmark.py [--inputs inputs5] [--capacity 1 5 10] [--difficulty 4 5]
+                          [--rate 10] [--lines N] [--port 8000] [--output report.json]
+'''
+
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# parse arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--inputs', help='directory with a transactionsN.txt file for each participant', default='inputs5')
+parser.add_argument('--capacity', help='values of BLOCK_CAPACITY', type=int, nargs='+', default=[5])
+parser.add_argument('--difficulty', help='values of DIFFICULTY', type=int, nargs='+', default=[4])
+parser.add_argument('--rate', help='transactions per second sent to each participant (0 for no limit)', type=float, default=10)
+parser.add_argument('--lines', help='only send the first N lines of each file', type=int)
+parser.add_argument('--port', help='port of the first participant (coordinator)', type=int, default=8000)
+parser.add_argument('--timeout', help='seconds to wait for the chains to settle', type=float, default=120)
+parser.add_argument('--logs', help='keep the output of each participant in this directory')
+parser.add_argument('--output', help='write the report to this file, instead of stdout')
+args = parser.parse_args()
+
+################################################################################
+
+def percentile(values, p):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def metric(i, name):
+    '''value of metric `name` of participant `i` (summed over labels), from /metrics/'''
+    total = 0
+    for line in requests.get(f'{host(i)}/metrics/').text.splitlines():
+        sample, _, value = line.rpartition(' ')
+        if sample.split('{')[0] == name:
+            total += float(value)
+
+    return int(total)
+
+
+def start_nodes(count, capacity, difficulty, logs):
+    env = dict(os.environ)
+    env.pop('NOOBCASH_DATA_DIR', None)
+    env.update({
+        'NOOBCASH_BLOCK_CAPACITY': str(capacity),
+        'NOOBCASH_DIFFICULTY': str(difficulty),
+        'NOOBCASH_COORDINATOR_PORT': str(args.port),
+        # so that logs are complete while the participants run
+        'PYTHONUNBUFFERED': '1'
+    })
+
+    procs = []
+    for i in range(count):
+        out = open(os.path.join(logs, f'node{i}.log'), 'w')
+        procs.append(subprocess.Popen(
+            [sys.executable, 'manage.py', 'runserver', '--noreload', f'127.0.0.1:{args.port + i}'],
+            cwd=BASE_DIR, env=env, stdout=out, stderr=subprocess.STDOUT
+        ))
+
+    # wait for all of them to come up
+    for i in range(count):
+        for _ in range(100):
+            try:
+                requests.get(f'{host(i)}/get_blockchain_length/', timeout=1)
+                break
+            except requests.exceptions.RequestException:
+                time.sleep(0.1)
+
+    return procs
+
+
+def host(i):
+    return f'http://127.0.0.1:{args.port + i}'
+
+
+def connect(count):
+    '''init coordinator and participants. @return tokens, pubkeys (by id)'''
+    tokens = [requests.post(f'{host(0)}/init_server/', {'num_participants': count, 'host': host(0)}).text]
+    for i in range(1, count):
+        response = requests.post(f'{host(i)}/init_client/', {'host': host(i)})
+        if response.status_code != 200:
+            raise Exception(f'participant {i} could not connect')
+
+        tokens.append(response.text)
+
+    # initial transactions (100 NBC each) are sent by the coordinator
+    while len(requests.get(f'{host(count - 1)}/get_balance/').json()) < count:
+        time.sleep(0.1)
+
+    balance = requests.get(f'{host(0)}/get_balance/').json()
+    return tokens, {int(k): v['pubkey'] for k, v in balance.items()}
+
+
+def send(i, token, pubkeys, lines, sent):
+    '''send transactions of file `lines` to participant `i`, at `args.rate` per second'''
+    session = requests.Session()
+    start = time.time()
+    for n, line in enumerate(lines):
+        idx, amount = line.split()
+        recepient = int(idx[2:])
+        if recepient not in pubkeys:
+            continue
+
+        if args.rate:
+            time.sleep(max(0, start + n / args.rate - time.time()))
+
+        response = session.post(f'{host(i)}/create_transaction/', {
+            'token': token,
+            'recepient': pubkeys[recepient],
+            'amount': amount
+        })
+        if response.status_code == 200:
+            sent[i] += 1
+
+
+def settle(count):
+    '''wait until all participants agree on the chain, and nothing is left to mine'''
+    deadline = time.time() + args.timeout
+    last = None
+    while time.time() < deadline:
+        tips = []
+        for i in range(count):
+            blocks = requests.get(f'{host(i)}/get_transactions/').json()
+            pending = requests.get(f'{host(i)}/get_num_pending_transactions/').json()['num_pending']
+            length = requests.get(f'{host(i)}/get_blockchain_length/').json()['blockchain_length']
+            tips.append((length, json.dumps(blocks), pending == 0))
+
+        if len(set(tips)) == 1 and tips[0][2]:
+            # same tip everywhere, for a couple of seconds
+            if last == tips[0]:
+                return True
+            last = tips[0]
+        else:
+            last = None
+
+        time.sleep(1)
+
+    return False
+
+
+def run(capacity, difficulty):
+    files = sorted(f for f in os.listdir(os.path.join(BASE_DIR, args.inputs)) if f.startswith('transactions'))
+    count = len(files)
+
+    if args.logs:
+        logs = os.path.join(args.logs, f'c{capacity}-d{difficulty}')
+        os.makedirs(logs, exist_ok=True)
+    else:
+        logs = tempfile.mkdtemp(prefix='noobcash-benchmark-')
+
+    procs = start_nodes(count, capacity, difficulty, logs)
+    try:
+        tokens, pubkeys = connect(count)
+
+        workload = []
+        for fname in files:
+            with open(os.path.join(BASE_DIR, args.inputs, fname), 'r') as fin:
+                lines = [line for line in fin if line.strip()]
+            workload.append(lines[:args.lines])
+
+        sent = [0] * count
+        start = time.time()
+        start_timestamp = datetime.datetime.now()
+        threads = [threading.Thread(target=send, args=(i, tokens[i], pubkeys, workload[i], sent)) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        send_time = time.time() - start
+
+        settled = settle(count)
+
+        # final chain, as seen by the coordinator
+        response = requests.get(f'{host(0)}/get_blockchain/', params={'from_height': 1})
+        blocks = [json.loads(line)['block'] for line in response.iter_lines() if line]
+
+        timestamps = [datetime.datetime.fromisoformat(b['timestamp']) for b in blocks]
+        block_times = [(b - a).total_seconds() for a, b in zip(timestamps, timestamps[1:])]
+        # without the initial transactions of the coordinator
+        committed = sum(len(b['transactions']) for b in blocks) - (count - 1)
+
+        # until the last block was mined
+        elapsed = max(send_time, (timestamps[-1] - start_timestamp).total_seconds() if timestamps else 0)
+
+        mined = sum(requests.get(f'{host(i)}/get_num_blocks_created/').json()['num_blocks'] for i in range(count))
+        bytes_sent = sum(metric(i, 'noobcash_peer_bytes_total') for i in range(count))
+
+        consensus_runs = sum(metric(i, 'noobcash_consensus_seconds_count') for i in range(count))
+
+        return {
+            'participants': count,
+            'block_capacity': capacity,
+            'difficulty': difficulty,
+            'rate': args.rate,
+            'settled': settled,
+            'sent': sum(sent),
+            'committed': committed,
+            'send_time': send_time,
+            'elapsed': elapsed,
+            'tps': committed / elapsed,
+            'blocks': len(blocks),
+            'block_time': {
+                'mean': sum(block_times) / len(block_times) if block_times else None,
+                'p95': percentile(block_times, 95)
+            },
+            'blocks_mined': mined,
+            'fork_rate': (mined - len(blocks)) / mined if mined else 0,
+            'consensus_runs': consensus_runs,
+            'bytes_sent': bytes_sent
+        }
+
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+
+################################################################################
+
+report = []
+for capacity in args.capacity:
+    for difficulty in args.difficulty:
+        print(f'benchmark: BLOCK_CAPACITY={capacity} DIFFICULTY={difficulty}', file=sys.stderr)
+        report.append(run(capacity, difficulty))
+
+output = json.dumps({'inputs': args.inputs, 'runs': report}, indent=4)
+if args.output:
+    with open(args.output, 'w') as fout:
+        fout.write(output)
+else:
+    print(output)
@@ -6,6 +6,8 @@ Usage:
 
 import os
 import sys
+import json
+import time
 import requests
 import argparse
 
@@ -46,10 +48,58 @@ Extra commands:
 
 * `view_all`                    View transactions of all validated blocks so far
 * `latest_balance`              View balance of each wallet (as of last received transaction)
+* `watch [height]`              Print new blocks, transactions and forks as they happen (Ctrl-C to stop),
+                                starting with the blocks after `height`
 '''
 
 ################################################################################
 
+def print_event(event):
+    if event['type'] == 'block':
+        print(f'Block {event["height"]}: (SHA: {event["hash"][:15]})\t{event["transactions"]} transactions')
+    elif event['type'] == 'transaction':
+        print(f'{event["sender_id"]}\t->\t{event["recepient_id"]}\t{event["amount"]}\tNBC\t{event["tx_id"][:10]}')
+    elif event['type'] == 'fork':
+        print(f'Fork at block {event["fork"]}: adopted chain up to {event["height"]}, dropped {event["dropped"]} blocks')
+    elif event['type'] == 'reset':
+        print(f'Missed some events, chain is at block {event["height"]}')
+
+
+def watch(params):
+    '''
+    print events of the participant, streamed (or long-polled, if the server cannot stream).
+    reconnects if the connection drops, e.g. the participant restarted
+    '''
+    while True:
+        try:
+            with requests.get(f'{HOST}/events/', params=params, headers={'Accept': 'text/event-stream'}, stream=True) as response:
+                if response.status_code != 200:
+                    print(f'Error: {response.text}')
+                    return
+
+                if response.headers.get('Content-Type', '').startswith('text/event-stream'):
+                    # small chunks, print events as soon as they arrive
+                    for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+                        if line.startswith('data: '):
+                            event = json.loads(line[len('data: '):])
+                            print_event(event)
+                            params = {'since': event['id']}
+                    continue
+
+                body = response.json()
+
+        except requests.exceptions.RequestException:
+            # the participant sends a reset event if we missed any
+            time.sleep(1)
+            continue
+
+        for event in body['events']:
+            print_event(event)
+
+        params = {'since': body['last_id']}
+
+################################################################################
+
 # init participant
 API = f'{HOST}/init_server/' if PARTICIPANTS else f'{HOST}/init_client/'
 
@@ -133,24 +183,40 @@ while True:
         parts = cmd.split()
         participants = requests.get(f'{HOST}/get_balance/').json()
 
+        def send_batch(batch):
+            API = f'{HOST}/create_transactions/'
+            response = requests.post(API, {
+                'token': TOKEN,
+                'transactions': json.dumps(batch)
+            })
+
+            if response.status_code == 200:
+                ids = response.json()['transactions']
+                print(f'OK. {len(ids) - ids.count(None)}/{len(ids)} transactions')
+            else:
+                print(f'Error: {response.text}')
+
+        # send BATCH_SIZE transactions in each request
         try:
             fname = parts[1]
             with open(fname, 'r') as fin:
+                batch = []
                 for line in fin:
-                    idx, amount = line.split()
-                    recepient = participants[idx[2:]]['pubkey']
+                    if not line.strip():
+                        continue
 
-                    API = f'{HOST}/create_transaction/'
-                    response = requests.post(API, {
-                        'token': TOKEN,
-                        'recepient': recepient,
+                    idx, amount = line.split()
+                    batch.append({
+                        'recepient': participants[idx[2:]]['pubkey'],
                         'amount': amount
                     })
 
-                    if response.status_code == 200:
-                        print('OK.')
-                    else:
-                        print(f'Error: {response.text}')
+                    if len(batch) == settings.BATCH_SIZE:
+                        send_batch(batch)
+                        batch = []
+
+                if batch:
+                    send_batch(batch)
         except Exception as e:
             print(f'error: {e.__class__.__name__}: {e}')
 
@@ -172,6 +238,15 @@ while True:
         else:
             print('Error')
 
+    elif cmd.startswith('watch'):
+        parts = cmd.split()
+        try:
+            watch({'since_height': int(parts[1])} if len(parts) > 1 else {})
+        except KeyboardInterrupt:
+            print()
+        except Exception as e:
+            print(f'error: {e.__class__.__name__}: {e}')
+
     elif cmd == 'help':
         print(help_message)
 
@@ -0,0 +1,20 @@
+"""
+ASGI config for noobcash project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Peer and client endpoints are served by async views (`noobcash/backend/views/aio.py`).
+
+Usage (with any ASGI server, e.g. uvicorn):
+    $ uvicorn noobcash.asgi:application --port 8000
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'noobcash.settings_asgi')
+
+application = get_asgi_application()
+
+from noobcash.backend.apps import start
+start()
@@ -0,0 +1,21 @@
+# apps.py
+
+import threading
+
+from django.apps import AppConfig
+
+
+class BackendConfig(AppConfig):
+    name = 'noobcash.backend'
+
+
+def start():
+    '''
+    load stored blocks. called when the server starts (see `wsgi.py` and `asgi.py`),
+    not for other management commands
+    '''
+    from noobcash.backend import store, consensus, writer
+
+    # restarted, catch up with blocks we missed while down
+    if writer.submit(store.load):
+        threading.Thread(target=consensus.consensus, daemon=True).start()
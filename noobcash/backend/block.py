@@ -1,16 +1,38 @@
 # block.py
 
-import copy
 import json
 import datetime
 
 from Crypto.Hash import SHA384
 
-from noobcash.backend import settings, miner, state
+from noobcash.backend import settings, state, store, metrics, events
 from noobcash.backend.transaction import Transaction
+from noobcash.backend.mempool import Mempool
+from noobcash.backend.index import ChainIndex
 
 ################################################################################
 
+# block hashes are 384-bit numbers, a block is valid if its hash is smaller than its target
+MAX_TARGET = 2 ** 384 - 1
+
+
+def initial_target():
+    '''target of the genesis block, hashes with DIFFICULTY leading hex zeros'''
+    return 16 ** (96 - settings.DIFFICULTY)
+
+
+def _time(block):
+    return datetime.datetime.fromisoformat(block.timestamp)
+
+
+def easiest_target(tip):
+    '''
+    the easiest target a block on top of unknown blocks may have: one retarget from `tip`.
+    such blocks need this much work to make us ask other participants for their chain
+    '''
+    return min(tip.target * settings.RETARGET_FACTOR, MAX_TARGET)
+
+
 class Block(object):
     '''
     A block object has the following fields
@@ -23,19 +45,42 @@ class Block(object):
 
     'index': index of this block in the chain
     'timestamp': time of block creation
+
+    'undo': utxo changes made by this block, used to roll it back (see `UTXOView.revert`)
+    'target': the hash must be smaller than this. not sent, derived from the chain (see `next_target`)
+
+    once it has a hash, a block cannot be changed, and its json strings (and parsed
+    transactions) are cached
     '''
 
+    __slots__ = ('transactions', 'nonce', 'current_hash', 'previous_hash', 'index', 'timestamp', 'undo', 'target', '_dump', '_sendable', '_parsed')
+
+    # fixed once the block has a hash
+    FIELDS = ('transactions', 'nonce', 'current_hash', 'previous_hash', 'timestamp')
+
     def __init__(self, transactions, nonce, current_hash, previous_hash, index, timestamp=None):
         '''dummy create new block'''
-        self.transactions = transactions
+        self.transactions = tuple(transactions)
         self.nonce = nonce
-        self.current_hash = current_hash
         self.previous_hash = previous_hash
 
         self.index = index
-        self.timestamp = timestamp
-        if timestamp is None:
-            self.timestamp = str(datetime.datetime.now())
+        self.timestamp = timestamp if timestamp is not None else str(datetime.datetime.now())
+
+        self.undo = None
+        self.target = initial_target() if index == 0 else None
+        self._dump = None
+        self._sendable = None
+        self._parsed = None
+
+        self.current_hash = current_hash
+
+
+    def __setattr__(self, name, value):
+        if name in Block.FIELDS and getattr(self, 'current_hash', None) is not None:
+            raise AttributeError(f'block is sealed, cannot change {name}')
+
+        object.__setattr__(self, name, value)
 
 
     def __eq__(self, o):
@@ -51,13 +96,14 @@ class Block(object):
 
     def dump_sendable(self):
         ''' sendable json string '''
-        return json.dumps(dict(
-            timestamp=self.timestamp,
-            transactions=self.transactions,
-            nonce=self.nonce,
-            current_hash=self.current_hash,
-            previous_hash=self.previous_hash
-        ), sort_keys=True)
+        if self._sendable is not None:
+            return self._sendable
+
+        sendable = json.dumps(self.dict(), sort_keys=True)
+        if self.current_hash is not None:
+            self._sendable = sendable
+
+        return sendable
 
 
     def dict(self):
@@ -69,26 +115,170 @@ class Block(object):
             previous_hash=self.previous_hash
         )
 
-    def dump(self):
-        ''' used for calculating hash '''
+
+    def parsed_transactions(self):
+        '''transactions of the block, as `Transaction` objects'''
+        if self._parsed is not None:
+            return self._parsed
+
+        parsed = tuple(Transaction(**json.loads(tx_json)) for tx_json in self.transactions)
+        if self.current_hash is not None:
+            self._parsed = parsed
+
+        return parsed
+
+
+    @staticmethod
+    def dump_prefix(transactions, timestamp):
+        '''
+        fixed part of the string used for calculating the hash, the nonce is appended to it.
+        this way, the miner hashes the prefix once and then only the nonce for each attempt
+        '''
         return json.dumps(dict(
-            transactions=self.transactions,
-            nonce=self.nonce,
-            timestamp=self.timestamp
+            transactions=transactions,
+            timestamp=timestamp
         ), sort_keys=True)
 
 
+    def dump(self):
+        ''' used for calculating hash '''
+        if self._dump is not None:
+            return self._dump
+
+        dump = Block.dump_prefix(self.transactions, self.timestamp) + str(self.nonce)
+        if self.current_hash is not None:
+            self._dump = dump
+
+        return dump
+
+
     def calculate_hash(self):
         ''' dont calculate hash '''
         return SHA384.new(self.dump().encode())
 
 
+    def verify(self, previous=None):
+        '''
+        check block size, hash, proof of work (`self.target` must be set) and timestamp:
+        after the one of `previous` (the parent block, if we have it) and at most
+        BLOCK_MAX_FUTURE seconds ahead of our clock. raises an Exception if invalid
+        '''
+        if not 0 < len(self.transactions) <= settings.BLOCK_CAPACITY:
+            raise Exception('invalid block capacity')
+        if sum(map(len, self.transactions)) > settings.BLOCK_MAX_BYTES:
+            raise Exception('invalid block size')
+        if self.calculate_hash().hexdigest() != self.current_hash:
+            raise Exception('invalid block hash')
+        if int(self.current_hash, 16) >= self.target:
+            raise Exception('invalid proof of work')
+
+        # retargeting depends on timestamps, see `next_target`
+        try:
+            timestamp = _time(self)
+        except (TypeError, ValueError):
+            raise Exception('invalid block timestamp')
+        if timestamp.tzinfo is not None:
+            raise Exception('invalid block timestamp')
+        if previous is not None and timestamp <= _time(previous):
+            raise Exception('block timestamp is not after its parent')
+        if timestamp > datetime.datetime.now() + datetime.timedelta(seconds=settings.BLOCK_MAX_FUTURE):
+            raise Exception('block timestamp is in the future')
+
+
+    @staticmethod
+    def next_target(chain, index=None):
+        '''
+        target of the block with index `index` (default: the block after `chain`), on
+        top of the blocks of `chain` before it (list of blocks, `chain[i]` has index i).
+
+        same as the last block, except for every RETARGET_EVERY blocks: then, it is scaled
+        by how long the last RETARGET_EVERY blocks took compared to BLOCK_TIME each
+        (blocks came too fast: smaller target, harder to mine). integer arithmetic only,
+        so that all participants get the same target for the same chain
+        '''
+        index = len(chain) if index is None else index
+        previous = chain[index - 1]
+        if index % settings.RETARGET_EVERY != 0:
+            return previous.target
+
+        first = chain[max(index - 1 - settings.RETARGET_EVERY, 0)]
+        expected = int((previous.index - first.index) * settings.BLOCK_TIME * 1000000)
+        if expected <= 0:
+            return previous.target
+
+        # microseconds, clamped
+        actual = (_time(previous) - _time(first)) // datetime.timedelta(microseconds=1)
+        actual = min(max(actual, expected // settings.RETARGET_FACTOR), expected * settings.RETARGET_FACTOR)
+
+        return max(1, min(previous.target * actual // expected, MAX_TARGET))
+
+
+    def apply(self, utxos):
+        '''
+        apply the transactions of the block on `utxos`, keep the changes in `self.undo`.
+
+        transactions are applied on a copy-on-write view of `utxos`, so nothing is changed
+        (and there is nothing to roll back) if any of them is invalid. otherwise, the view
+        is committed in O(block size).
+
+        raises an Exception if the block has invalid transactions
+        @return set of ids of the block transactions
+        '''
+        transactions = self.parsed_transactions()
+
+        # check all signatures at once, `apply()` will find them cached
+        if not all(Transaction.verify_signatures(transactions)):
+            raise Exception('invalid block transaction: invalid signature')
+
+        view = utxos.overlay()
+        block_tx_ids = set()
+        for t in transactions:
+            if t.id in block_tx_ids:
+                raise Exception('invalid block transaction: duplicate transaction')
+
+            # this will make sure transactions are valid, and it will update utxos as well
+            t.apply(view)
+            block_tx_ids.add(t.id)
+
+        # all good, this is final
+        view.commit()
+        self.undo = view
+
+        return block_tx_ids
+
+
+    @staticmethod
+    def _append(block):
+        '''
+        apply the transactions of `block` on top of the validated utxos and append it to the chain.
+        then, re-play pending transactions that did not make it into the block.
+
+        raises an Exception if the block has invalid transactions, state is not altered
+        '''
+        block_tx_ids = block.apply(state.valid_utxos)
+        state.blockchain.append(block)
+        state.index.add(block)
+        store.append([block])
+        events.emit('block', height=block.index, hash=block.current_hash, transactions=len(block.transactions))
+
+        # update sendable blockchain (without genesis block)
+        state.blockchain_public.append(block.dump_sendable().encode())
+
+        # re-play the other transactions that are still waiting to enter a block
+        # If any one fails, sender is fraudulent, but oh well
+        pending = state.transactions
+        state.transactions = Mempool()
+        state.utxos = state.valid_utxos.overlay()
+        for tx in pending:
+            if tx.id not in block_tx_ids:
+                tx.replay()
+
+
     @staticmethod
-    def validate_block(json_string, update_public=True):
+    @metrics.validate_block.time()
+    def validate_block(json_string):
         '''
-        validate incoming block. if @update_public is False, then public blockchain is not updated.
-        this is so that the consensus algorithm (which calls validate_block a handful of times) runs
-        faster.
+        validate incoming block (json string, or dict of fields decoded from the wire).
 
         @return
         * 'οκ'        <-- everything went ok, block was added in the blockchain (along with any new transactions)
@@ -101,79 +291,40 @@ class Block(object):
                if the chain length is bigger, we should receive another block soon.
 
                --> in any case, we can safely drop this block, even if it is valid
+
+        IMPORTANT NOTE: global state is not altered in case of an invalid block
         '''
         # acquire locks for everything
         with state.lock:
             try:
-                # save state, in order to properly restore in case of a bad block
-                TRANSACTIONS_BACKUP = copy.deepcopy(state.transactions)
-                UTXOS_BACKUP = copy.deepcopy(state.utxos)
-                BLOCKCHAIN_BACKUP = copy.deepcopy(state.blockchain)
-                VALID_UTXOS_BACKUP = copy.deepcopy(state.valid_utxos)
-
-                prev_block = state.blockchain[-1]
-                block = Block(**json.loads(json_string), index=prev_block.index+1)
-
-                if len(block.transactions) != settings.BLOCK_CAPACITY:
-                    raise Exception('invalid block capacity')
-                if block.calculate_hash().hexdigest() != block.current_hash:
-                    raise Exception('invalid block hash')
-                if not block.current_hash.startswith('0' * settings.DIFFICULTY):
-                    raise Exception('invalid proof of work')
-
-                if block.previous_hash == prev_block.current_hash:
-                    # HO-HO-HO, OUR LUCKY DAY
-
-                    # start from utxos as of last block
-                    state.utxos = copy.deepcopy(state.valid_utxos)
-                    state.transactions = []
-
-                    for tx_json in block.transactions:
-                        # this will make sure transactions are valid, and it will update utxos as well
-                        status, block_tx = Transaction.validate_transaction(tx_json)
-                        if status != 'added':
-                            raise Exception(f'invalid block transaction: validation returned {status}')
-
-                        # remove transaction after validating
-                        state.transactions.remove(block_tx)
-
-                    # append block, update valid utxos
-                    state.blockchain.append(block)
-                    state.valid_utxos = copy.deepcopy(state.utxos)
-
-                    # update sendable blockchain (without genesis block)
-                    if update_public:
-                        with state.blockchain_public_lock:
-                            state.blockchain_public.append(block.dump_sendable())
+                fields = json_string if isinstance(json_string, dict) else json.loads(json_string)
+
+                # its target depends on the chain it extends, find the parent first
+                parent = state.index.blocks.get(fields['previous_hash'])
+                if parent is None:
+                    # unknown block, ask other nodes. its target depends on blocks we
+                    # do not have, it is checked again if we switch to its chain
+                    block = Block(**fields, index=len(state.blockchain))
+                    block.target = easiest_target(state.blockchain[-1])
+                    block.verify()
+                    return 'consensus'
 
-                    # re-play the other transactions that are still waiting to enter a block
-                    # If any one fails, sender is fraudulent, but oh well
-                    for tx in TRANSACTIONS_BACKUP:
-                        tx_json = tx.dump_sendable()
-                        if tx_json not in block.transactions:
-                            status, tx = Transaction.validate_transaction(tx_json)
+                block = Block(**fields, index=parent + 1)
+                block.target = Block.next_target(state.blockchain, parent + 1)
+                block.verify(state.blockchain[parent])
 
+                if parent == len(state.blockchain) - 1:
+                    # HO-HO-HO, OUR LUCKY DAY
+                    Block._append(block)
                     return 'ok'
 
-                else:
-                    for existing_block in state.blockchain[:-1]:
-                        if existing_block.current_hash == block.previous_hash:
-                            # the new block's parent is a previous block. so this new block
-                            # creates a different chain, one whose length is not larger
-                            # than the one we have. we may choose whichever chain we want,
-                            # we choose our own for simplicity
-                            return 'dropped'
-
-                    # unknown block, ask other nodes
-                    return 'consensus'
+                # the new block's parent is a previous block. so this new block
+                # creates a different chain, one whose length is not larger
+                # than the one we have. we may choose whichever chain we want,
+                # we choose our own for simplicity
+                return 'dropped'
 
             except Exception as e:
-                # restore state and return
-                state.transactions = TRANSACTIONS_BACKUP
-                state.blockchain = BLOCKCHAIN_BACKUP
-                state.utxos = UTXOS_BACKUP
-                state.valid_utxos = VALID_UTXOS_BACKUP
-
                 print(f'Block.validate_block: {e.__class__.__name__}: {e}')
                 return 'error'
 
@@ -187,51 +338,18 @@ class Block(object):
         try:
             # lock and go
             with state.lock:
-                TRANSACTIONS_BACKUP = copy.deepcopy(state.transactions)
-                UTXOS_BACKUP = copy.deepcopy(state.utxos)
-                VALID_UTXOS_BACKUP = copy.deepcopy(state.valid_utxos)
-
                 block = Block(
-                    transactions=copy.deepcopy(transactions),
+                    transactions=transactions,
                     nonce=nonce,
                     current_hash=sha,
                     previous_hash=state.blockchain[-1].current_hash,
                     index=len(state.blockchain),
                     timestamp=timestamp
                 )
+                block.target = Block.next_target(state.blockchain)
+                block.verify(state.blockchain[-1])
 
-                if len(block.transactions) != settings.BLOCK_CAPACITY:
-                    raise Exception('invalid block capacity')
-                if block.current_hash != block.calculate_hash().hexdigest():
-                    raise Exception('invalid block hash')
-                if not block.current_hash.startswith('0' * settings.DIFFICULTY):
-                    raise Exception('invalid proof of work')
-
-                # start from utxos of last block
-                state.utxos = copy.deepcopy(state.valid_utxos)
-                state.transactions = []
-
-                for tx_json_string in transactions:
-                    status, t = Transaction.validate_transaction(tx_json_string)
-                    if status != 'added':
-                        raise Exception('transaction already exists')
-
-                # remove them again
-                state.transactions = []
-
-                # append to blockchain, update valid utxos
-                state.blockchain.append(block)
-                state.valid_utxos = copy.deepcopy(state.utxos)
-
-                # update sendable blockchain (without genesis block)
-                with state.blockchain_public_lock:
-                    state.blockchain_public.append(block.dump_sendable())
-
-                # re-play transactions waiting to enter a block
-                for tx in TRANSACTIONS_BACKUP:
-                    tx_json_string = tx.dump_sendable()
-                    if tx_json_string not in transactions:
-                        status, t = Transaction.validate_transaction(tx_json_string)
+                Block._append(block)
 
                 # plus one
                 state.num_blocks_created += 1
@@ -239,9 +357,6 @@ class Block(object):
                 return block
 
         except Exception as e:
-            state.transactions = TRANSACTIONS_BACKUP
-            state.utxos = UTXOS_BACKUP
-            state.valid_utxos = VALID_UTXOS_BACKUP
             print(f'Block.create_block: {e.__class__.__name__}: {e}')
             return None
 
@@ -262,17 +377,19 @@ class Block(object):
                     nonce=0,
                     previous_hash='1',
                     index=0,
-                    current_hash='placeholder'
+                    current_hash=None
                 )
 
                 block.current_hash = block.calculate_hash().hexdigest()
 
                 state.blockchain = [block]
-                state.transactions = []
-                state.valid_utxos = copy.deepcopy(state.utxos)
+                state.index = ChainIndex.from_chain(state.blockchain)
+                state.transactions = Mempool()
+                state.valid_utxos = state.utxos.copy()
+                state.utxos = state.valid_utxos.overlay()
 
                 state.genesis_block = Block(**json.loads(block.dump_sendable()), index=0)
-                state.genesis_utxos = copy.deepcopy(state.utxos)
+                state.genesis_utxos = state.valid_utxos.copy()
 
             return True
 
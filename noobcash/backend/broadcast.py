@@ -1,26 +1,163 @@
 # broadcast.py
 
+import queue
+import threading
+import time
+
 import requests
-from noobcash.backend import state
+from noobcash.backend import state, settings, wire, metrics
 
-def broadcast(api: str, message: dict, wait=False):
-    '''hit `{host}/{api}/` of all hosts, with data `message`'''
 
-    kwargs = {}
-    if not wait:
-        kwargs['timeout'] = 1
+class Peer(object):
+    '''
+    Outbound connection to another participant.
 
-    for h in state.other_hosts:
+    Messages are posted in order by a worker thread, over a keep-alive session.
+    The queue of messages is bounded, new messages are dropped if the peer falls
+    too far behind.
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        self.session = requests.Session()
+        self.queue = queue.Queue(maxsize=settings.BROADCAST_QUEUE_SIZE)
+
+        # statistics
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def send(self, api, message, timeout=None, done=None, on_response=None):
+        '''
+        queue `message` for `{host}/{api}/`, set event `done` when it is sent (or dropped).
+        `message` may be a function, called when it is sent. `on_response(peer, response)`
+        is called by the worker thread if the peer accepts the message.
+        @return False if the message is dropped
+        '''
+        try:
+            self.queue.put_nowait((api, message, timeout, done, on_response))
+        except queue.Full:
+            self.dropped += 1
+            print(f'broadcast: Queue for "{self.host}" is full, dropping "{api}"')
+            if done is not None:
+                done.set()
+
+            return False
+
+        return True
+
+
+    def post(self, api, message, timeout=None):
+        '''post `message` to `{host}/{api}/` now. @return the response, None on failure'''
+        start = time.time()
+        r = None
         try:
-            r = requests.post(f'{h}/{api}/', message, **kwargs)
+            if isinstance(message, bytes):
+                r = self.session.post(f'{self.host}/{api}/', message, timeout=timeout,
+                                      headers={'Content-Type': wire.CONTENT_TYPE})
+            else:
+                r = self.session.post(f'{self.host}/{api}/', message, timeout=timeout)
 
             # cant do too much
             if r.status_code != 200:
-                print(f'broadcast: Request "{h}/{api}" failed')
+                self.failed += 1
+                print(f'broadcast: Request "{self.host}/{api}" failed')
+            else:
+                self.sent += 1
+
+            self.bytes_sent += len(r.request.body or b'')
+            metrics.peer_bytes.inc(len(r.request.body or b'') + len(r.content))
 
         except requests.exceptions.Timeout:
-            print(f'broadcast: Request "{h}/{api}" timed out')
-            pass
+            self.failed += 1
+            print(f'broadcast: Request "{self.host}/{api}" timed out')
+        except Exception as e:
+            self.failed += 1
+            print(f'broadcast: Request "{self.host}/{api}": {e.__class__.__name__}: {e}')
+
+        latency = time.time() - start
+        metrics.broadcast.observe(latency, peer=self.host)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        return r if r is not None and r.status_code == 200 else None
+
+
+    def _run(self):
+        while True:
+            api, message, timeout, done, on_response = self.queue.get()
+            try:
+                if callable(message):
+                    message = message()
+
+                r = self.post(api, message, timeout)
+                if r is not None and on_response is not None:
+                    on_response(self, r)
+
+            except Exception as e:
+                print(f'broadcast: "{self.host}/{api}": {e.__class__.__name__}: {e}')
+
+            if done is not None:
+                done.set()
+
+
+    def stats(self):
+        count = self.sent + self.failed
+        return {
+            'host': self.host,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'bytes_sent': self.bytes_sent,
+            'queued': self.queue.qsize(),
+            'mean_latency': self.total_latency / count if count else 0,
+            'max_latency': self.max_latency
+        }
+
+
+# Peers, by host
+_peers = {}
+_peers_lock = threading.Lock()
+
+def peer(host):
+    '''get (or create) the connection to `host`'''
+    with _peers_lock:
+        if host not in _peers:
+            _peers[host] = Peer(host)
+
+        return _peers[host]
+
+
+def stats():
+    '''statistics for each peer'''
+    with _peers_lock:
+        return [p.stats() for p in _peers.values()]
+
+
+def broadcast(api: str, message: dict, wait=False):
+    '''
+    hit `{host}/{api}/` of all hosts, with data `message` (form fields, or a binary message).
+    returns immediately, unless `wait` is set. messages reach each host in order.
+    '''
+
+    timeout = None if wait else settings.BROADCAST_TIMEOUT
+
+    events = []
+    for h in state.other_hosts:
+        done = threading.Event() if wait else None
+        peer(h).send(api, message, timeout, done)
+        events.append(done)
+
+    if wait:
+        for done in events:
+            done.wait()
 
 
 
@@ -32,6 +169,6 @@ import sys
 if __name__ == '__main__':
     api = sys.argv[1]
     message = json.loads(sys.argv[2])
-    hosts = json.loads(sys.argv[3])
+    state.other_hosts = json.loads(sys.argv[3])
 
-    broadcast(api, message, hosts)
+    broadcast(api, message, wait=True)
@@ -1,95 +1,390 @@
-from noobcash.backend import state
+from noobcash.backend import state, settings, wire, store, writer, metrics, events
 from noobcash.backend.block import Block, Transaction
+from noobcash.backend.mempool import Mempool
 
 import json
-import copy
+import asyncio
+import threading
 import requests
 
-def validate_chain(blockchain, pending):
+from concurrent.futures import ThreadPoolExecutor
+
+def headers_for_wire():
+    '''ask for binary responses, if configured'''
+    if settings.WIRE_FORMAT == 'binary':
+        return {'Accept': wire.CONTENT_TYPE}
+
+    return {}
+
+
+def _connects(blockchain, start, headers):
+    '''
+    True if the headers of another participant from index `start` extend our
+    `blockchain` at `start`, False to look further back
+    '''
+    if headers and headers[0]['previous_hash'] == blockchain[start - 1].current_hash:
+        return True
+
+    if start == 1:
+        raise Exception('chain does not start from our genesis block')
+
+    return False
+
+
+def _skip_common(blockchain, start, headers):
+    '''@return index of the first of `headers` (from index `start`) that is not in our `blockchain`'''
+    fork = start
+    for header in headers:
+        if fork >= len(blockchain) or header['current_hash'] != blockchain[fork].current_hash:
+            break
+        fork += 1
+
+    return fork
+
+
+def _search_fork(snapshot):
+    '''
+    the fork search of `find_fork()`, without the requests: a generator that yields the
+    index to ask get_headers/ from, and is sent the page of headers it answers.
+    @return (fork, count)
+    '''
+    blockchain = snapshot.blocks()
+    length = len(blockchain)
+    window = settings.CONSENSUS_WINDOW
+
+    while True:
+        start = max(1, length - window)
+        page = yield start
+
+        # only longer chains are interesting
+        if page['height'] <= length:
+            return length, 0
+
+        if _connects(blockchain, start, page['headers']):
+            break
+
+        window *= 2
+
+    # skip blocks we already have
+    fork = _skip_common(blockchain, start, page['headers'])
+    while fork == page['next']:
+        page = yield fork
+        fork = _skip_common(blockchain, fork, page['headers'])
+
+    return fork, max(page['height'] - fork, 0)
+
+
+def _headers(response):
+    '''@return the page of headers of a get_headers/ `response`'''
+    if response.status_code != 200:
+        raise Exception('invalid headers response')
+
+    metrics.peer_bytes.inc(len(response.content))
+    return response.json()
+
+
+def _is_binary(response):
+    return response.headers.get('Content-Type') == wire.CONTENT_TYPE
+
+
+def _blocks(response, body, count):
+    '''
+    blocks of a get_blockchain/ `response`, with `body` its binary content or its NDJSON
+    lines. @return list of dicts of block fields, raises an Exception unless there are `count`
+    '''
+    if response.status_code != 200:
+        raise Exception('invalid blockchain response')
+
+    if _is_binary(response):
+        metrics.peer_bytes.inc(len(body))
+        received = wire.decode_blocks(body)
+    else:
+        lines = [line for line in body if line]
+        metrics.peer_bytes.inc(sum(len(line) + 1 for line in lines))
+        received = [json.loads(line)['block'] for line in lines]
+
+    if len(received) < count:
+        raise Exception('blockchain changed while fetching blocks')
+
+    return received
+
+
+def find_fork(host, snapshot):
     '''
-    Check if `blockchain` is a valid chain of blocks.
-    Also update `transactions` and `utxos` for it.
+    Ask `host` for its block headers, find the last block both chains have in common
+    (our chain as of `snapshot`).
+
+    Headers are requested starting a few blocks below our tip, going further back
+    until the first received header extends our chain. They come in pages of at
+    most MAX_BATCH_SIZE, following ones are requested while they match our chain.
+
+    @return (fork, count), where `fork` is the index of the first block that differs
+    and `count` is the number of blocks of `host` from `fork` onwards. `count` is 0 if
+    the chain of `host` is not longer than ours.
+    '''
+    search = _search_fork(snapshot)
+    try:
+        start = next(search)
+        while True:
+            response = requests.get(f'{host}/get_headers/', {'from': start}, timeout=settings.CONSENSUS_TIMEOUT)
+            start = search.send(_headers(response))
+
+    except StopIteration as e:
+        return e.value
+
 
-    @return True if valid, False otherwise
+def fetch_blocks(host, start, count):
+    '''
+    get `count` blocks of `host` starting from index `start`, in a single streamed request.
+    @return list of dicts of block fields
+    '''
+    params = {'from_height': start, 'limit': count}
+    with requests.get(f'{host}/get_blockchain/', params=params, headers=headers_for_wire(), stream=True,
+                      timeout=settings.CONSENSUS_TIMEOUT) as response:
+        return _blocks(response, response.content if _is_binary(response) else response.iter_lines(), count)
+
+
+def switch_chain(fork, received):
+    '''
+    Replace our blocks from index `fork` onwards with the `received` blocks (dicts of fields).
+
+    Our blocks after the fork are rolled back using their undo logs and only the received
+    blocks are validated, all on a view of the validated utxos. State is not altered if any
+    of the received blocks is invalid.
+
+    Transactions of the dropped blocks are re-played along with the pending ones.
+
+    Raises an Exception if the received blocks do not make our chain longer (it may have
+    grown since they were fetched).
     '''
     with state.lock:
-        # restart from genesis block
-        state.blockchain = [state.genesis_block]
-        state.utxos = copy.deepcopy(state.genesis_utxos)
-        state.valid_utxos = copy.deepcopy(state.genesis_utxos)
-
-        state.transactions = []
-
-        # for the chain to be valid, we have to be able to append each block
-        # without errors.
-        index = 1
-        for block in blockchain:
-            # `Block.validate_block()` will also update any pending transactions
-            # with conflicting inputs
-            res = Block.validate_block(block, update_public=False)
-            if res != 'ok':
-                return False
+        if fork + len(received) <= len(state.blockchain):
+            raise Exception('blockchain is not longer anymore')
+
+        view = state.valid_utxos.overlay()
+        for block in reversed(state.blockchain[fork:]):
+            block.undo.revert(view)
+
+        # new list, the old one may be in use by readers (see `writer.Snapshot`)
+        chain = state.blockchain[:fork]
+        block_tx_ids = set()
+        for fields in received:
+            previous = chain[-1]
+            block = Block(**fields, index=previous.index + 1)
+            block.target = Block.next_target(chain)
+            block.verify(previous)
+            if block.previous_hash != previous.current_hash:
+                raise Exception('received blocks are not a chain')
+
+            block_tx_ids |= block.apply(view)
+            chain.append(block)
+
+        # all good, switch to the received chain
+        view.commit()
+        blocks = chain[fork:]
+        dropped = state.blockchain[fork:]
+        state.blockchain = chain
+
+        index = state.index.copy()
+        for block in reversed(dropped):
+            index.remove(block)
+        for block in blocks:
+            index.add(block)
+        state.index = index
+
+        store.truncate(fork)
+        store.append(blocks)
+
+        events.emit('fork', fork=fork, height=chain[-1].index, hash=chain[-1].current_hash, dropped=len(dropped))
+        for block in blocks:
+            events.emit('block', height=block.index, hash=block.current_hash, transactions=len(block.transactions))
+
+        # update sendable blockchain (without genesis block)
+        state.blockchain_public = state.blockchain_public[:fork - 1] + [b.dump_sendable().encode() for b in blocks]
 
         # play transactions over
+        pending = [Transaction(**json.loads(tx_json)) for b in dropped for tx_json in b.transactions]
+        pending.extend(state.transactions)
+
+        state.transactions = Mempool()
+        state.utxos = state.valid_utxos.overlay()
         for tx in pending:
-            tx_json = tx.dump_sendable()
-            Transaction.validate_transaction(tx_json)
+            if tx.id not in block_tx_ids:
+                tx.replay()
+
+
+def fetch_chain(host, snapshot):
+    '''
+    get the blocks of `host` after the last block in common with our chain (as of `snapshot`).
+    @return (fork, received), `received` is empty if the chain of `host` is not longer
+    '''
+    # only fetch and validate the blocks after the common ancestor
+    fork, count = find_fork(host, snapshot)
+    if not count:
+        return fork, []
+
+    return fork, fetch_blocks(host, fork, count)
+
+
+def _peers(snapshot):
+    '''hosts of the other participants, by id'''
+    return {p['id']: p['host'] for p in snapshot.participants.values() if p['id'] != snapshot.participant_id}
 
+
+def _candidates(peers, results):
+    '''
+    chains fetched from `peers` (`results` has (fork, received) or an Exception for each),
+    longest first. @return list of (pid, fork, received)
+    '''
+    candidates = []
+    for pid, result in zip(peers, results):
+        if isinstance(result, Exception):
+            print(f'consensus.{pid}: {result.__class__.__name__}: {result}')
+        elif not result[1]:
+            print(f'consensus.{pid}: Ignoring blockchain that is not longer')
+        else:
+            candidates.append((pid, *result))
+
+    return sorted(candidates, key=lambda c: c[1] + len(c[2]), reverse=True)
+
+
+def _adopt(candidates):
+    '''switch to the first valid chain of `candidates` (see `_candidates()`). runs on the writer'''
+    for pid, fork, received in candidates:
+        try:
+            switch_chain(fork, received)
+            print(f'consensus.{pid}: Adopted chain, replaced {len(received)} blocks from {fork}')
+            return
+
+        except Exception as e:
+            print(f'consensus.{pid}: {e.__class__.__name__}: {e}')
+
+
+# consensus runs one at a time. calls made while it is running do not start another
+# run, they ask the running one to go again once it is done, which serves all of them
+_lock = threading.Lock()
+_running = False
+_again = False
+
+def _begin():
+    '''@return True if the caller should run consensus, False if the run in progress takes over'''
+    global _running, _again
+    with _lock:
+        if _running:
+            _again = True
+            return False
+
+        _running = True
         return True
 
+
+def _done():
+    '''a run is over. @return True if it should run again, for calls made in the meantime'''
+    global _running, _again
+    with _lock:
+        if _again:
+            _again = False
+            return True
+
+        _running = False
+        return False
+
+
+def _fetch_chain(host, snapshot):
+    '''see `fetch_chain()`. @return the Exception instead of raising it'''
+    try:
+        return fetch_chain(host, snapshot)
+    except Exception as e:
+        return e
+
+
 def consensus():
-    # we don't want someone else to interfere while asking for consensus
-    # lock up the darkness
-    with state.lock:
-        # keep backup
-        MAX_BLOCKCHAIN = copy.deepcopy(state.blockchain)
-        MAX_BLOCKCHAIN_PUBLIC = copy.deepcopy(state.blockchain_public)
-        MAX_TRANSACTIONS = copy.deepcopy(state.transactions)
-        MAX_UTXOS = copy.deepcopy(state.utxos)
-        MAX_VALID_UTXOS = copy.deepcopy(state.valid_utxos)
-        MAX_LENGTH = len(MAX_BLOCKCHAIN)
-        TRANSACTIONS_BACKUP = copy.deepcopy(state.transactions)
-
-        for participant in state.participants.values():
-            # skip self
-            if participant['id'] == state.participant_id:
-                continue
-
-            try:
-                pid = participant['id']
-                host = participant['host']
-                api = f'{host}/get_blockchain/'
-
-                response = requests.get(api)
-                if response.status_code != 200:
-                    raise Exception('invalid blockchain response')
-
-                received_blockchain = json.loads(response.json()['blockchain'])
-
-                # NOTE: we received the blockchain WITHOUT the genesis block. This means
-                # that the received chain size is actually `len(received_blockchain) + 1`
-                # We want to keep chains with length > MAX_LENGTH
-                if len(received_blockchain) < MAX_LENGTH:
-                    print(f'consensus.{pid}: Ignoring shorter blockchain {len(received_blockchain)}')
-                    continue
-
-                if not validate_chain(received_blockchain, TRANSACTIONS_BACKUP):
-                    raise Exception('received invalid chain')
-
-                # if chain is valid, update
-                MAX_BLOCKCHAIN = copy.deepcopy(state.blockchain)
-                MAX_BLOCKCHAIN_PUBLIC = [b.dump_sendable() for b in state.blockchain[1:]]
-                MAX_TRANSACTIONS = copy.deepcopy(state.transactions)
-                MAX_UTXOS = copy.deepcopy(state.utxos)
-                MAX_VALID_UTXOS = copy.deepcopy(state.valid_utxos)
-                MAX_LENGTH = len(MAX_BLOCKCHAIN)
-
-            except Exception as e:
-                print(f'consensus.{pid}: {e.__class__.__name__}: {e}')
-
-        # update with best blockchain found
-        state.blockchain = MAX_BLOCKCHAIN
-        state.blockchain_public = MAX_BLOCKCHAIN_PUBLIC
-        state.transactions = MAX_TRANSACTIONS
-        state.utxos = MAX_UTXOS
-        state.valid_utxos = MAX_VALID_UTXOS
+    '''
+    Ask all participants for their chain, adopt the longest valid one.
+
+    Chains are fetched from all participants at the same time, without locking the state
+    and with a timeout for each request. Only switching to the chosen chain goes through
+    the writer.
+
+    If consensus is running already, returns right away: the run in progress goes
+    again once it is done (once for all the calls made in the meantime)
+    '''
+    if not _begin():
+        return
+
+    while True:
+        try:
+            _consensus()
+        except Exception as e:
+            print(f'consensus: {e.__class__.__name__}: {e}')
+
+        if not _done():
+            return
+
+
+@metrics.consensus.time()
+def _consensus():
+    snapshot = state.snapshot
+    peers = _peers(snapshot)
+    if not peers:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(peers)) as pool:
+        results = list(pool.map(lambda host: _fetch_chain(host, snapshot), peers.values()))
+
+    writer.submit(_adopt, _candidates(peers, results))
+
+################################################################################
+# Same as above, for the async views (see `views/aio.py`). `client` is an httpx.AsyncClient
+
+async def find_fork_async(client, host, snapshot):
+    '''see `find_fork()`'''
+    search = _search_fork(snapshot)
+    try:
+        start = next(search)
+        while True:
+            response = await client.get(f'{host}/get_headers/', params={'from': start}, timeout=settings.CONSENSUS_TIMEOUT)
+            start = search.send(_headers(response))
+
+    except StopIteration as e:
+        return e.value
+
+
+async def fetch_chain_async(client, host, snapshot):
+    '''see `fetch_chain()`'''
+    fork, count = await find_fork_async(client, host, snapshot)
+    if not count:
+        return fork, []
+
+    params = {'from_height': fork, 'limit': count}
+    response = await client.get(f'{host}/get_blockchain/', params=params, headers=headers_for_wire(),
+                                timeout=settings.CONSENSUS_TIMEOUT)
+    return fork, _blocks(response, response.content if _is_binary(response) else response.content.splitlines(), count)
+
+
+async def consensus_async(client):
+    '''see `consensus()`. the chains are fetched on the event loop, without a thread for each participant'''
+    if not _begin():
+        return
+
+    while True:
+        try:
+            await _consensus_async(client)
+        except Exception as e:
+            print(f'consensus: {e.__class__.__name__}: {e}')
+
+        if not _done():
+            return
+
+
+@metrics.consensus.time()
+async def _consensus_async(client):
+    snapshot = state.snapshot
+    peers = _peers(snapshot)
+    if not peers:
+        return
+
+    results = await asyncio.gather(*[fetch_chain_async(client, host, snapshot) for host in peers.values()],
+                                   return_exceptions=True)
+
+    await asyncio.wrap_future(writer.post(_adopt, _candidates(peers, results)))
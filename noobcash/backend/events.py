@@ -0,0 +1,71 @@
+# events.py
+# Feed of changes to the state (new blocks, accepted transactions, adopted forks), see `events/`
+
+import threading
+
+from collections import deque
+from itertools import islice
+
+from noobcash.backend import settings
+
+################################################################################
+
+# last EVENTS_BUFFER events, oldest first. each one is a dict `{id, type, ...}`,
+# ids go up by one
+_events = deque(maxlen=settings.EVENTS_BUFFER)
+_last_id = 0
+_cond = threading.Condition()
+
+# events of the change the writer is running. they are sent out after the change
+# is published (see `writer._run`), so that readers find them in the snapshot
+_pending = []
+
+
+def emit(type, **data):
+    '''record an event. called while changing the state, holding `state.lock`'''
+    _pending.append(dict(type=type, **data))
+
+
+def flush():
+    '''send out the events of the last change, holding `state.lock`'''
+    global _last_id
+    if not _pending:
+        return
+
+    with _cond:
+        for event in _pending:
+            _last_id += 1
+            event['id'] = _last_id
+            _events.append(event)
+
+        _pending.clear()
+        _cond.notify_all()
+
+
+def last_id():
+    '''id of the latest event, 0 if there are none'''
+    return _last_id
+
+
+def since(event_id):
+    '''
+    @return (events after `event_id`, complete). `complete` is False if some of
+    them are not kept anymore, or if `event_id` was never sent (e.g. it is from
+    before a restart)
+    '''
+    with _cond:
+        if event_id > _last_id:
+            return [], False
+
+        if not _events or event_id == _last_id:
+            return [], True
+
+        first = _events[0]['id']
+        return list(islice(_events, max(event_id + 1 - first, 0), None)), event_id + 1 >= first
+
+
+def wait(event_id, timeout):
+    '''wait up to `timeout` seconds for events after `event_id`. @return same as `since()`'''
+    with _cond:
+        _cond.wait_for(lambda: _last_id != event_id, timeout)
+        return since(event_id)
@@ -0,0 +1,182 @@
+# gossip.py
+# Relay new transactions and blocks to GOSSIP_FANOUT random participants, which relay
+# them in turn once they accept them. Transactions are announced by id (inv/), and
+# participants ask for the ones they have not accepted. Transactions received before the
+# ones they spend are kept as orphans until those arrive. Blocks are pushed as compact
+# blocks, they are small and every round trip makes forks more likely
+
+import json
+import random
+import threading
+import time
+
+from collections import OrderedDict
+
+from noobcash.backend import state, settings, wire, broadcast
+
+################################################################################
+
+# ids of transactions accepted (created or validated), least recently used first.
+# `_seen[id] = True`
+_seen = OrderedDict()
+
+# ids of transactions asked for, that have not been accepted (yet). they are asked for
+# again if announced after GOSSIP_REQUEST_TIMEOUT seconds, in case the answer was lost
+# or invalid. `_requested[id] = time asked`, oldest first
+_requested = OrderedDict()
+
+# transactions announced to others, so that they can be sent when asked for.
+# `_announced[id] = Transaction`, least recently used first
+_announced = OrderedDict()
+
+# ids waiting to be announced to each host, sent with the next `inv/` message to it.
+# `_outbox[host] = [transaction ids]`
+_outbox = {}
+
+# received transactions whose inputs we do not have (yet), e.g. relayed before the
+# transaction they spend. `_orphans[id] = Transaction`, oldest first, and
+# `_orphans_by_input[input id] = {ids of orphans spending it}`
+_orphans = OrderedDict()
+_orphans_by_input = {}
+
+_lock = threading.Lock()
+
+
+def _remember(cache, key, value, size=None):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > (size or settings.GOSSIP_CACHE_SIZE):
+        return cache.popitem(last=False)
+
+
+def _fanout():
+    '''GOSSIP_FANOUT random hosts'''
+    hosts = list(state.other_hosts)
+    return random.sample(hosts, min(settings.GOSSIP_FANOUT, len(hosts)))
+
+
+def mark_seen(tx_ids):
+    '''mark transactions as accepted, they are not asked for anymore'''
+    with _lock:
+        for tx_id in tx_ids:
+            _remember(_seen, tx_id, True)
+            _requested.pop(tx_id, None)
+
+
+def add_orphan(t):
+    '''keep a transaction whose inputs we do not have, see `take_orphans()`. runs on the writer'''
+    with _lock:
+        evicted = _remember(_orphans, t.id, t, settings.GOSSIP_ORPHANS)
+        for txin_id in t.inputs:
+            _orphans_by_input.setdefault(txin_id, set()).add(t.id)
+
+        if evicted is not None:
+            _forget_orphan(evicted[1])
+
+
+def _forget_orphan(t):
+    for txin_id in t.inputs:
+        ids = _orphans_by_input.get(txin_id)
+        if ids is not None:
+            ids.discard(t.id)
+            if not ids:
+                del _orphans_by_input[txin_id]
+
+
+def take_orphans(tx_id):
+    '''@return orphans spending outputs of transaction `tx_id`, removed from the pool. runs on the writer'''
+    with _lock:
+        result = []
+        for orphan_id in list(_orphans_by_input.get(tx_id, ())):
+            t = _orphans.pop(orphan_id, None)
+            if t is not None:
+                _forget_orphan(t)
+                result.append(t)
+
+        return result
+
+
+def announce(transactions=(), blocks=()):
+    '''relay new transactions and blocks to GOSSIP_FANOUT random participants'''
+    if transactions:
+        tx_ids = [t.id for t in transactions]
+        mark_seen(tx_ids)
+        with _lock:
+            for t in transactions:
+                _remember(_announced, t.id, t)
+
+        for host in _fanout():
+            with _lock:
+                queued = host in _outbox
+                _outbox.setdefault(host, []).extend(tx_ids)
+
+            # ids announced while an `inv/` message is waiting are sent along with it
+            if not queued:
+                _queue_inv(host)
+
+    for block in blocks:
+        if settings.COMPACT_BLOCKS:
+            api, message = 'receive_compact_block', wire.compact_block_message(block)
+        else:
+            api, message = 'receive_block', wire.block_message(block)
+
+        for host in _fanout():
+            broadcast.peer(host).send(api, message, settings.BROADCAST_TIMEOUT)
+
+
+def _queue_inv(host):
+    if not broadcast.peer(host).send('inv', lambda: _inv_message(host), settings.BROADCAST_TIMEOUT, on_response=_send_wanted):
+        # the peer is too far behind, it gets these from others (or with the next block)
+        with _lock:
+            _outbox.pop(host, None)
+
+
+def _inv_message(host):
+    '''message for `inv/`, with the ids waiting for `host` (up to MAX_BATCH_SIZE)'''
+    with _lock:
+        tx_ids = _outbox.pop(host)
+        tx_ids, rest = tx_ids[:settings.MAX_BATCH_SIZE], tx_ids[settings.MAX_BATCH_SIZE:]
+        if rest:
+            _outbox[host] = rest
+
+    if rest:
+        _queue_inv(host)
+
+    return {'inv': json.dumps({'transactions': tx_ids})}
+
+
+def _send_wanted(peer, response):
+    '''send the transactions `peer` asked for, in its worker thread'''
+    with _lock:
+        transactions = [_announced.get(tx_id) for tx_id in response.json()['transactions']]
+
+    transactions = [t for t in transactions if t is not None]
+    if transactions:
+        peer.post('receive_transactions', wire.transactions_message(transactions), settings.BROADCAST_TIMEOUT)
+
+
+def wanted(inv):
+    '''
+    transaction ids in `inv` (`{transactions}`, as announced by another participant)
+    that we have not accepted, and have not asked for in the last GOSSIP_REQUEST_TIMEOUT
+    seconds. they are marked as asked for.
+    @return {'transactions': [...]}
+    '''
+    if len(inv['transactions']) > settings.MAX_BATCH_SIZE:
+        raise Exception('too many ids')
+
+    now = time.monotonic()
+    result = []
+    with _lock:
+        for tx_id in inv['transactions']:
+            if tx_id in _seen or tx_id in _orphans:
+                continue
+
+            asked = _requested.get(tx_id)
+            if asked is not None and now - asked < settings.GOSSIP_REQUEST_TIMEOUT:
+                continue
+
+            _remember(_requested, tx_id, now)
+            result.append(tx_id)
+
+    return {'transactions': result}
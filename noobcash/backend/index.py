@@ -0,0 +1,60 @@
+# index.py
+
+class ChainIndex(object):
+    '''
+    Lookup indexes of the blocks in the chain.
+
+    `transactions[id] = (block index, position in block)`
+    `blocks[hash] = block index`
+    `history[pubkey] = [ids of transactions sent or received by pubkey]`, oldest first
+
+    add and remove are O(block size). Like the chain, an index is only added to once
+    readers may use it (see `writer.Snapshot`): entries of blocks beyond the height
+    of a snapshot are ignored, and dropping blocks is done on a copy.
+    '''
+
+    def __init__(self):
+        self.transactions = {}
+        self.blocks = {}
+        self.history = {}
+
+
+    def add(self, block):
+        '''index a block that was appended to the chain'''
+        for pos, t in enumerate(block.parsed_transactions()):
+            self.transactions[t.id] = (block.index, pos)
+            self.history.setdefault(t.sender, []).append(t.id)
+            if t.recepient != t.sender:
+                self.history.setdefault(t.recepient, []).append(t.id)
+
+        self.blocks[block.current_hash] = block.index
+
+
+    def remove(self, block):
+        '''drop a block, it must be the last one added'''
+        for t in reversed(block.parsed_transactions()):
+            self.transactions.pop(t.id, None)
+            for who in {t.sender, t.recepient}:
+                ids = self.history.get(who)
+                if ids and ids[-1] == t.id:
+                    ids.pop()
+
+        self.blocks.pop(block.current_hash, None)
+
+
+    def copy(self):
+        result = ChainIndex()
+        result.transactions = dict(self.transactions)
+        result.blocks = dict(self.blocks)
+        result.history = {who: list(ids) for who, ids in self.history.items()}
+        return result
+
+
+    @staticmethod
+    def from_chain(chain):
+        '''index all blocks of `chain`'''
+        result = ChainIndex()
+        for block in chain:
+            result.add(block)
+
+        return result
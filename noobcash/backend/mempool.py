@@ -0,0 +1,75 @@
+# mempool.py
+
+from collections import OrderedDict
+from itertools import count, islice
+
+# versions of all mempools, so that a new mempool never has the version of an old one
+_versions = count(1)
+
+class Mempool(object):
+    '''
+    Pending transactions (not yet in a block), keyed by transaction id,
+    in the order they were received.
+
+    contains and add are O(1), remove is O(size), `take_block(n, ...)` is O(n).
+    `version` changes whenever transactions are added or removed.
+
+    `log` lists the transactions in order. It is only appended to (a new list is
+    created when a transaction is removed), so readers of other threads can look at
+    its first items without locking (see `writer.Snapshot`)
+    '''
+
+    def __init__(self):
+        self._transactions = OrderedDict()
+        self.log = []
+        self.version = next(_versions)
+
+
+    def __contains__(self, t):
+        '''check for a transaction (or transaction id)'''
+        return getattr(t, 'id', t) in self._transactions
+
+
+    def __len__(self):
+        return len(self._transactions)
+
+
+    def __iter__(self):
+        return iter(list(self._transactions.values()))
+
+
+    def get(self, id):
+        return self._transactions.get(id)
+
+
+    def add(self, t):
+        if t.id not in self._transactions:
+            self.log.append(t)
+
+        self._transactions[t.id] = t
+        self.version = next(_versions)
+
+
+    def remove(self, t):
+        '''remove a transaction (or transaction id), if it is there'''
+        if self._transactions.pop(getattr(t, 'id', t), None) is not None:
+            self.log = list(self._transactions.values())
+            self.version = next(_versions)
+
+
+    def take_block(self, n, max_bytes):
+        '''
+        transactions for a block, oldest first: at most `n`, with json strings
+        of at most `max_bytes` in total. @return list of json strings
+        '''
+        transactions = []
+        size = 0
+        for t in islice(self._transactions.values(), n):
+            tx_json = t.dump_sendable()
+            if size + len(tx_json) > max_bytes:
+                break
+
+            transactions.append(tx_json)
+            size += len(tx_json)
+
+        return transactions
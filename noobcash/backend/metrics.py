@@ -0,0 +1,200 @@
+# metrics.py
+# Counters, gauges and histograms, exported in the Prometheus text format (/metrics/)
+
+import time
+import asyncio
+import threading
+
+from functools import wraps
+
+################################################################################
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+# all metrics, in the order they were defined
+_registry = []
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter(object):
+    '''value that only goes up, e.g. number of blocks. `fn` is read on export instead, if set'''
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def export(self):
+        value = self.fn() if self.fn is not None else self.value
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter', f'{self.name} {value}']
+
+
+class Gauge(object):
+    '''value that goes up and down, read from `fn` on export'''
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        _registry.append(self)
+
+    def export(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.fn()}']
+
+
+class Histogram(object):
+    '''
+    distribution of durations (seconds), optionally split by labels, e.g.
+    `observe(0.1, peer='http://...')`
+    '''
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+        # labels -> [count of each bucket, count, sum]
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            counts = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+
+            counts[1] += 1
+            counts[2] += value
+
+    def time(self, **labels):
+        '''decorator, observe the duration of each call (or await, for coroutine functions)'''
+        def decorator(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await fn(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, **labels)
+
+                return async_wrapper
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+    def export(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            values = [(key, list(buckets), count, total) for key, (buckets, count, total) in self.values.items()]
+
+        for key, buckets, count, total in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{_labels(key + (("le", bound),))} {cumulative}')
+
+            lines.append(f'{self.name}_bucket{_labels(key + (("le", "+Inf"),))} {count}')
+            lines.append(f'{self.name}_count{_labels(key)} {count}')
+            lines.append(f'{self.name}_sum{_labels(key)} {total}')
+
+        return lines
+
+
+class TimedLock(object):
+    '''
+    re-entrant lock that records how long threads wait for it, and how long
+    they hold it (from the outermost acquire to the matching release)
+    '''
+
+    def __init__(self, wait, hold):
+        self._lock = threading.RLock()
+        self._wait = wait
+        self._hold = hold
+
+        # only changed while holding the lock
+        self._depth = 0
+        self._acquired = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+
+        self._depth += 1
+        if self._depth == 1:
+            self._acquired = time.perf_counter()
+            self._wait.observe(self._acquired - start)
+
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._hold.observe(time.perf_counter() - self._acquired)
+
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def export():
+    '''@return all metrics, in the Prometheus text format'''
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.export())
+        except Exception as e:
+            print(f'metrics.export: {metric.name}: {e.__class__.__name__}: {e}')
+
+    return '\n'.join(lines) + '\n'
+
+################################################################################
+
+# Histograms of the hot paths. Gauges are defined along with the state they read
+
+validate_transaction = Histogram('noobcash_validate_transaction_seconds', 'Time to validate an incoming transaction')
+validate_block = Histogram('noobcash_validate_block_seconds', 'Time to validate an incoming block')
+consensus = Histogram('noobcash_consensus_seconds', 'Time to ask all participants for their chain and adopt the longest')
+broadcast = Histogram('noobcash_broadcast_seconds', 'Time to send a message to a participant')
+lock_wait = Histogram('noobcash_lock_wait_seconds', 'Time spent waiting for the state lock')
+lock_hold = Histogram('noobcash_lock_hold_seconds', 'Time the state lock is held')
+
+# everything sent to other participants: broadcasts, gossip, consensus and compact block
+# fetches, counted by whoever makes the request (bodies only, not HTTP headers)
+peer_bytes = Counter('noobcash_peer_bytes_total', 'Bytes of requests to other participants and of their responses')
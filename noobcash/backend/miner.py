@@ -1,134 +1,259 @@
-import os, django, sys
-import json
+# miner.py
+
+import os
 import datetime
-import requests
+import hashlib
+import threading
+import multiprocessing
 
 from random import seed, randint
-from subprocess import Popen
-from signal import SIGTERM
-from Crypto.Hash import SHA384
+
+from noobcash.backend import settings, state, gossip, writer, metrics
+from noobcash.backend.block import Block
 
 ################################################################################
 
-# Set up django
-BASE = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-sys.path.append(BASE)
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'noobcash.settings')
-django.setup()
+# nonces are 32-bit values
+MAX_NONCE = 4294967295
+
+# how often workers check if their job was cancelled
+CHECK_EVERY = 1000
+
+# how often workers refresh the timestamp of the block
+TIMESTAMP_EVERY = 100000
+
+def target_bytes(target):
+    '''
+    `target` as 48 bytes, big endian, like the raw SHA384 digests. comparing digests
+    against it is cheaper than formatting hex strings
+    '''
+    return target.to_bytes(48, 'big')
+
+
+def do_mine(transactions, nonce, count, target, cancelled):
+    '''
+    try `count` nonces starting from `nonce`, until the hash is good or
+    until `cancelled()` returns True. `target` is in bytes (see `target_bytes`)
+
+    the block hash is `SHA384(prefix + nonce)`, so the SHA384 state after the
+    prefix is computed once and copied for each nonce. the timestamp (part of
+    the prefix) is refreshed every `TIMESTAMP_EVERY` nonces.
+
+    @return (nonce, sha, timestamp), or None
+    '''
+    for i in range(count):
+        if i % CHECK_EVERY == 0 and cancelled():
+            return None
+
+        if i % TIMESTAMP_EVERY == 0:
+            timestamp = str(datetime.datetime.now())
+            prefix = hashlib.sha384(Block.dump_prefix(transactions, timestamp).encode())
+
+        h = prefix.copy()
+        h.update(str(nonce).encode())
+
+        # got it
+        if h.digest() < target:
+            return nonce, h.hexdigest(), timestamp
+
+        # DISCUSS
+        # * use next value
+        # * use random value
+
+        nonce = (nonce + 1) % MAX_NONCE
+
+    return None
+
+
+def _worker(conn, job, found, hashes, index):
+    '''
+    mining worker process, one for each core.
+    receives jobs `(job_id, transactions, nonce, count, target)` from `conn`,
+    drops a job as soon as the shared `job` value changes, sends results to `found`.
+    counts hashes in `hashes[index]`, CHECK_EVERY at a time
+    '''
+    parent = os.getppid()
+
+    while True:
+        try:
+            job_id, transactions, nonce, count, target = conn.recv()
+        except EOFError:
+            # participant is gone
+            return
+
+        def cancelled():
+            hashes[index] += CHECK_EVERY
+            return job.value != job_id or os.getppid() != parent
+
+        # the range is tried again until the job is found or cancelled, with a fresh
+        # timestamp (so a different block prefix) every time
+        res = None
+        while res is None and job.value == job_id and os.getppid() == parent:
+            res = do_mine(transactions, nonce, count, target, cancelled)
+
+        if os.getppid() != parent:
+            return
+
+        if res is not None:
+            found.put((job_id, transactions, *res))
+
 
 ################################################################################
 
-from noobcash.backend import settings, state
+class Pool(object):
+    '''
+    Long-lived mining worker processes, each trying a different range of nonces.
+
+    `job` is shared memory holding the id of the job being mined. Changing it
+    stops the workers, without killing them. `hashes` holds the number of hashes
+    computed by each worker.
+    '''
+
+    def __init__(self, num_workers):
+        ctx = multiprocessing.get_context('spawn')
+
+        self.job = ctx.RawValue('L', 0)
+        self.hashes = ctx.RawArray('Q', num_workers)
+        self.found = ctx.Queue()
+        self.conns = []
+
+        for i in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            ctx.Process(target=_worker, args=(child_conn, self.job, self.found, self.hashes, i), daemon=True).start()
+            self.conns.append(parent_conn)
+
+        threading.Thread(target=self._listen, daemon=True).start()
+
+
+    def mine(self, job_id, transactions, target):
+        '''start mining `transactions` for `target` (int), split nonces among workers'''
+        seed()
+
+        # compute a random 32-bit value, hopefully different for different participants
+        nonce = randint(0, MAX_NONCE)
+        count = MAX_NONCE // len(self.conns)
+        target = target_bytes(target)
+
+        self.job.value = job_id
+        for i, conn in enumerate(self.conns):
+            conn.send((job_id, transactions, (nonce + i * count) % MAX_NONCE, count, target))
+
+
+    def cancel(self):
+        '''stop the workers (they keep running, waiting for the next job)'''
+        self.job.value = 0
+
+
+    def _listen(self):
+        while True:
+            job_id, transactions, nonce, sha, timestamp = self.found.get()
+            try:
+                block = writer.submit(found_nonce, job_id, transactions, nonce, sha, timestamp)
+            except Exception as e:
+                print(f'miner.found_nonce: {e.__class__.__name__}: {e}')
+                continue
+
+            # the block is published by now, participants can fetch its transactions
+            if block is not None:
+                gossip.announce(blocks=[block])
+
 
-# dumb starter
-def _start(host, transactions):
-    try:
-        print('Starting miner')
-        proc = Popen(['python', __file__, host, json.dumps(transactions), state.token])
-        state.miner_pid = proc.pid
+_pool = None
 
-    except Exception as e:
-        print(f'miner.start: {e.__class__.__name__}: {e}')
+metrics.Counter('noobcash_miner_hashes_total', 'Hashes computed by the miner', lambda: sum(_pool.hashes) if _pool else 0)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = Pool(settings.MINER_PROCESSES or os.cpu_count() or 1)
+
+    return _pool
 
 
 def start():
-    host = state.participants[state.pubkey]['host']
-    transactions = [tx.dump_sendable() for tx in state.transactions[:settings.BLOCK_CAPACITY]]
+    with state.lock:
+        if state.miner_job is not None:
+            print('Miner running already: job', state.miner_job)
+            return
+
+        transactions = state.transactions.take_block(settings.BLOCK_CAPACITY, settings.BLOCK_MAX_BYTES)
+        if not transactions:
+            return
+
+        try:
+            print('Starting miner')
+            state.miner_job = state.miner_jobs_started = state.miner_jobs_started + 1
+            _get_pool().mine(state.miner_job, transactions, Block.next_target(state.blockchain))
+
+        except Exception as e:
+            state.miner_job = None
+            print(f'miner.start: {e.__class__.__name__}: {e}')
+
+
+# seals a block with whatever is pending, BLOCK_SEAL_TIMEOUT seconds after the miner
+# found pending transactions that could not fill a block
+_seal_timer = None
+
+def _seal():
+    '''the deadline passed, mine the pending transactions. runs on the writer'''
+    global _seal_timer
+    _seal_timer = None
+    if state.miner_job is None and len(state.transactions) > 0:
+        print('miner: sealing block with', len(state.transactions), 'pending transactions')
+        start()
+
 
-    try:
-        os.kill(state.miner_pid, 0)
-        print('Miner running already: PID', state.miner_pid)
-    except:
-        _start(host, transactions)
+def _block_full():
+    '''pending transactions are enough to fill a block, by count or by size'''
+    pending = len(state.transactions)
+    return (pending >= settings.BLOCK_CAPACITY
+        or len(state.transactions.take_block(settings.BLOCK_CAPACITY, settings.BLOCK_MAX_BYTES)) < pending)
 
 
 def start_if_needed():
     '''
-    starts miner if there are BLOCK_CAPACITY pending transactions
+    starts miner if there are enough pending transactions to fill a block.
+    otherwise, if there are any, they are mined after BLOCK_SEAL_TIMEOUT seconds
     returns True if miner was started
     '''
-    if len(state.transactions) >= settings.BLOCK_CAPACITY:
-        start()
-        return True
-    else:
-        return False
+    global _seal_timer
+    with state.lock:
+        if state.miner_job is None and _block_full():
+            start()
+            return True
 
+        if len(state.transactions) > 0 and _seal_timer is None:
+            _seal_timer = threading.Timer(settings.BLOCK_SEAL_TIMEOUT, writer.post, args=(_seal,))
+            _seal_timer.daemon = True
+            _seal_timer.start()
 
-def stop():
-    try:
-        if state.miner_pid is not None:
-            print('Killing miner: PID', state.miner_pid)
-            os.kill(state.miner_pid, SIGTERM)
-            state.miner_pid = None
-    except OSError as e:
-        if e.errno != os.errno.ESRCH:
-            print(f'miner.stop: {e.errno}: {e}')
-    except Exception as e:
-        print(f'miner.stop: {e.__class__.__name__}: {e}')
-
-
-###############################################################################
-
-def announce_nonce(host, transactions_json, nonce, sha, token, timestamp):
-    # NOTE: miner is a fragile process, it may get killed at any point
-    # dont start sending blocks around, if we die midway its gonna get bad
-    # just tell dad and exit, let him worry about sending crap around
-    api = f'{host}/create_block/'
-
-    # this will practically never return, host kills miner (us) when receiving a block
-    response = requests.post(api, {
-        'transactions': transactions_json,
-        'sha': sha,
-        'nonce': nonce,
-        'token': token,
-        'timestamp': timestamp
-    })
-
-    if response.status_code != 200:
-        print(f'miner.announce_nonce: request failed: {response.text}')
-
-    # FIXME: if we need to mine another block
-    exit(0)
-
-
-def do_mine(host, transactions_json, token):
-    # wtf
-    transactions = json.loads(transactions_json)
-    if len(transactions) != settings.BLOCK_CAPACITY:
-        print('Dont shit on me, Rogers, did you know?')
-        exit(-1)
-
-    # create base
-    base = {}
-    base['transactions'] = transactions
-
-    # try coming up with random numbers until hash is good
-    seed()
-
-    # compute a random 32-bit value, hopefully different for different participants
-    nonce = (randint(0, 4294967295) * state.participant_id) % 4294967295
-    while True:
-        base['nonce'] = nonce
-        base['timestamp'] = timestamp = str(datetime.datetime.now())
+        return False
 
-        base_json_string = json.dumps(base, sort_keys=True)
-        sha = SHA384.new(base_json_string.encode()).hexdigest()
 
-        # got it, tell everyone
-        if sha.startswith('0' * settings.DIFFICULTY):
-            announce_nonce(host, transactions_json, nonce, sha, token, timestamp)
-            exit(0)
+def stop():
+    with state.lock:
+        if state.miner_job is not None:
+            print('Stopping miner: job', state.miner_job)
+            _get_pool().cancel()
+            state.miner_job = None
 
-        # DISCUSS
-        # * use next value
-        # * use random value
 
-        nonce = (nonce + 1) % 4294967295
-        # nonce = randint(0, 4294967295)  # compute a random 32-bit value
+def found_nonce(job_id, transactions, nonce, sha, timestamp):
+    '''
+    a worker found `nonce` for the list of `transactions`.
+    the participant creates the block and appends to their own blockchain.
+    @return the block, to be announced, or None
+    '''
+    with state.lock:
+        # we may have moved on since the worker started, e.g. received a block
+        if job_id != state.miner_job:
+            print('miner.found_nonce: dropping nonce for cancelled job', job_id)
+            return
 
+        stop()
 
-################################################################################
+        # `create_block` will also make sure that the nonce is indeed correct
+        block = Block.create_block(transactions, nonce, sha, timestamp)
+        start_if_needed()
 
-if __name__ == '__main__':
-    # well, you know
-    do_mine(sys.argv[1], sys.argv[2], sys.argv[3])
+    return block
@@ -1,9 +1,89 @@
-## capacity of blocks
-BLOCK_CAPACITY = 5
+import os
 
-## difficulty
-DIFFICULTY = 4
+## max number of transactions and max size (sum of their json lengths) of blocks. the
+## miner starts as soon as a block can be filled, or when transactions have been waiting
+## for BLOCK_SEAL_TIMEOUT seconds (then blocks have between 1 and BLOCK_CAPACITY transactions)
+BLOCK_CAPACITY = int(os.environ.get('NOOBCASH_BLOCK_CAPACITY', 100))
+BLOCK_MAX_BYTES = 256 * 1024
+BLOCK_SEAL_TIMEOUT = float(os.environ.get('NOOBCASH_BLOCK_SEAL_TIMEOUT', 2))
+
+## initial difficulty, leading hex zeros of block hashes. the target (see `Block.next_target`)
+## is adjusted every RETARGET_EVERY blocks, so that a block is mined every BLOCK_TIME seconds.
+## each adjustment makes mining at most RETARGET_FACTOR times easier or harder
+DIFFICULTY = int(os.environ.get('NOOBCASH_DIFFICULTY', 4))
+BLOCK_TIME = float(os.environ.get('NOOBCASH_BLOCK_TIME', 5))
+RETARGET_EVERY = 10
+RETARGET_FACTOR = 4
+
+## blocks must be created after their parent, and at most this many seconds after
+## our own clock (limits how much a miner can make retargeting easier)
+BLOCK_MAX_FUTURE = BLOCK_TIME
+
+## number of mining processes, None for one per core
+MINER_PROCESSES = None
 
 ## coordinator host and port
-COORDINATOR_PORT = 8000
+COORDINATOR_PORT = int(os.environ.get('NOOBCASH_COORDINATOR_PORT', 8000))
 COORDINATOR = f'http://127.0.0.1:{COORDINATOR_PORT}'
+
+## number of blocks below our tip where consensus first looks for a common
+## ancestor with the chain of another participant (doubled until one is found)
+CONSENSUS_WINDOW = 8
+
+## seconds to wait for each participant when asking for their chain
+CONSENSUS_TIMEOUT = 5
+
+## max number of messages waiting to be sent to each participant
+BROADCAST_QUEUE_SIZE = 1000
+
+## seconds to wait for each participant to accept a broadcast message
+BROADCAST_TIMEOUT = 1
+
+## number of parsed public keys and of valid signatures kept in memory
+KEY_CACHE_SIZE = 256
+SIGNATURE_CACHE_SIZE = 100000
+
+## blocks with at least this many unverified signatures are verified in parallel
+## by VERIFY_PROCESSES worker processes (None for one per core)
+PARALLEL_VERIFY_MIN = 64
+VERIFY_PROCESSES = None
+
+## transactions sent in each request by the `source` command of the client, and the
+## max number of transactions accepted by create_transactions/ and receive_transactions/
+BATCH_SIZE = 100
+MAX_BATCH_SIZE = 1000
+
+## announce new blocks with the ids of their transactions only, participants fetch the
+## transactions they do not have (see `receive_compact_block/`). False to send whole blocks
+COMPACT_BLOCKS = True
+
+## new transactions and blocks are announced (ids only) to this many random participants,
+## which ask for the ones they have not seen and announce them in turn (see `gossip.py`)
+GOSSIP_FANOUT = int(os.environ.get('NOOBCASH_GOSSIP_FANOUT', 4))
+
+## number of transaction ids remembered as accepted, and of announced transactions
+## kept to send to participants that ask for them
+GOSSIP_CACHE_SIZE = 100000
+
+## seconds to wait for a transaction we asked for, before asking whoever announces it next
+GOSSIP_REQUEST_TIMEOUT = 5
+
+## max number of received transactions kept while the transactions they spend are missing
+GOSSIP_ORPHANS = 1000
+
+## format of transactions and blocks sent to other participants, 'json' or 'binary'
+## (see `wire.py`). participants accept both, regardless of this setting
+WIRE_FORMAT = 'json'
+
+## directory where blocks are stored, so that restarted participants pick up where
+## they left off (None to keep everything in memory). defaults to $NOOBCASH_DATA_DIR
+DATA_DIR = os.environ.get('NOOBCASH_DATA_DIR')
+
+## fsync the block log every this many blocks, save a utxo snapshot every this many blocks
+STORE_FSYNC_EVERY = 16
+STORE_SNAPSHOT_EVERY = 100
+
+## number of recent events (new blocks, transactions, forks) kept for events/, and max
+## seconds a long-poll request waits for one (streams send a keep-alive instead)
+EVENTS_BUFFER = 1000
+EVENTS_TIMEOUT = 30
@@ -1,18 +1,29 @@
 # state.py
 # Global state variables (excellent design choices)
 
-from threading import RLock
+from noobcash.backend import metrics
+from noobcash.backend.utxo import UTXOSet
+from noobcash.backend.mempool import Mempool
+from noobcash.backend.index import ChainIndex
 
 ################################################################################
 
-# Lock this before changing the global state
-lock = RLock()
+# Lock this before changing the global state. changes should go through
+# `writer.submit()`, which holds it. Re-entrant, wait and hold times are recorded
+lock = metrics.TimedLock(metrics.lock_wait, metrics.lock_hold)
+
+# Latest read-only copy of the state, see `writer.Snapshot`. Read this instead of
+# locking the state
+snapshot = None
 
 # List of validated blocks
 blockchain = []
 
-# List of valid transactions not yet in a block
-transactions = []
+# Transactions and blocks of the chain by id/hash, see `index.ChainIndex`
+index = ChainIndex()
+
+# Valid transactions not yet in a block, see `mempool.Mempool`
+transactions = Mempool()
 
 # List of participants `participants[pubkey] = {host, id}`
 participants = {}
@@ -34,22 +45,22 @@ privkey = None
 token = None
 
 # Unspent transactions of each participant
-# `utxos[pubkey] = [{transaction_id, who, amount}]`
-utxos = {}
+# `utxos.get(transaction_id, pubkey) = amount`, see `utxo.UTXOSet`
+utxos = UTXOSet()
 
 # Validated utxos, up to the point of the final validated block
-valid_utxos = {}
+valid_utxos = UTXOSet()
 
-# pid of miner (if running)
-miner_pid = None
+# id of the job the miner is working on (if running)
+miner_job = None
+miner_jobs_started = 0
 
 # Genesis block and utxos. Makes validating easier
 genesis_block = None
-genesis_utxos = []
+genesis_utxos = UTXOSet()
 
-# Sendable version of the blockchain
+# Sendable version of the blockchain, json of each block (without genesis) as utf-8 bytes
 blockchain_public = []
-blockchain_public_lock = RLock()
 
 # Used for statistics
 num_blocks_created = 0
\ No newline at end of file
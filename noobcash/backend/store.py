@@ -0,0 +1,275 @@
+# store.py
+# Persist the blockchain on local disk, so that a restarted participant does not start over
+
+import os
+import json
+import atexit
+import mmap
+import struct
+
+from noobcash.backend import state, settings
+from noobcash.backend.utxo import UTXOSet, UTXOView
+from noobcash.backend.mempool import Mempool
+from noobcash.backend.index import ChainIndex
+
+################################################################################
+
+# Files in settings.DATA_DIR
+#
+# node.json         keys, participants, genesis block and utxos. written once
+# blocks.log        append-only log of blocks, each record is `I length` followed by
+#                   json `{block, undo}`. record N is the block with index N
+# utxos.snapshot    json `{height, hash, utxos}`, validated utxos as of block `height`.
+#                   written every SNAPSHOT_EVERY blocks
+
+NODE = 'node.json'
+LOG = 'blocks.log'
+SNAPSHOT = 'utxos.snapshot'
+
+_RECORD_HEADER = struct.Struct('>I')
+
+# open log file, offsets of records (`_offsets[i]` is the offset of block i+1)
+_log = None
+_offsets = []
+
+# blocks written to the log since the last fsync
+_unsynced = 0
+
+# index of block of last snapshot
+_snapshot_height = 0
+
+
+def enabled():
+    return bool(settings.DATA_DIR)
+
+
+def _path(name):
+    return os.path.join(settings.DATA_DIR, name)
+
+
+def _write_atomic(name, data):
+    '''write a file, so that it is never found half-written'''
+    tmp = _path(name + '.tmp')
+    with open(tmp, 'wb') as fout:
+        fout.write(data)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+    os.replace(tmp, _path(name))
+
+
+def _open_log():
+    global _log
+    if _log is None:
+        os.makedirs(settings.DATA_DIR, exist_ok=True)
+        _log = open(_path(LOG), 'ab')
+
+    return _log
+
+
+def _sync():
+    global _unsynced
+    if _log is not None and _unsynced:
+        _log.flush()
+        os.fsync(_log.fileno())
+        _unsynced = 0
+
+atexit.register(_sync)
+
+################################################################################
+
+def save_node():
+    '''save keys, participants and genesis block. call once, after connecting'''
+    if not enabled():
+        return
+
+    os.makedirs(settings.DATA_DIR, exist_ok=True)
+    _write_atomic(NODE, json.dumps({
+        'privkey': state.privkey,
+        'pubkey': state.pubkey,
+        'token': state.token,
+        'participant_id': state.participant_id,
+        'participants': state.participants,
+        'genesis_block': state.genesis_block.dump_sendable(),
+        'genesis_utxos': state.genesis_utxos.dict()
+    }).encode())
+
+
+def snapshot():
+    '''save validated utxos as of the last block'''
+    global _snapshot_height
+    if not enabled():
+        return
+
+    # the snapshot must never be ahead of the log
+    _sync()
+
+    tip = state.blockchain[-1]
+    _write_atomic(SNAPSHOT, json.dumps({
+        'height': tip.index,
+        'hash': tip.current_hash,
+        'utxos': state.valid_utxos.dict()
+    }).encode())
+
+    _snapshot_height = tip.index
+
+
+def append(blocks):
+    '''
+    append `blocks` to the log. they must have just been appended to `state.blockchain`.
+    the log is synced every STORE_FSYNC_EVERY blocks
+    '''
+    global _unsynced
+    if not enabled():
+        return
+
+    log = _open_log()
+    for block in blocks:
+        data = json.dumps({'block': block.dump_sendable(), 'undo': block.undo.changes()}).encode()
+
+        _offsets.append(log.tell())
+        log.write(_RECORD_HEADER.pack(len(data)))
+        log.write(data)
+        _unsynced += 1
+
+    if state.blockchain[-1].index - _snapshot_height >= settings.STORE_SNAPSHOT_EVERY:
+        snapshot()
+    elif _unsynced >= settings.STORE_FSYNC_EVERY:
+        _sync()
+    else:
+        log.flush()
+
+
+def truncate(height):
+    '''drop blocks with index `height` and above from the log (e.g. after consensus)'''
+    global _snapshot_height
+    if not enabled() or height > len(_offsets):
+        return
+
+    log = _open_log()
+    log.flush()
+    log.truncate(_offsets[height - 1])
+    log.seek(_offsets[height - 1])
+    del _offsets[height - 1:]
+
+    # snapshot is ahead of the log now, drop it. a new one is taken on the next append
+    if _snapshot_height >= height:
+        os.remove(_path(SNAPSHOT))
+        _snapshot_height = 0
+
+################################################################################
+
+def _read_log():
+    '''@return list of (offset, record) in the log, up to the first broken record'''
+    path = _path(LOG)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return []
+
+    records = []
+    with open(path, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offset = 0
+        while offset + _RECORD_HEADER.size <= len(data):
+            length, = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            if start + length > len(data):
+                break
+
+            try:
+                records.append((offset, json.loads(data[start:start + length])))
+            except ValueError:
+                break
+
+            offset = start + length
+
+    return records
+
+
+def _read_snapshot():
+    try:
+        with open(_path(SNAPSHOT), 'r') as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return None
+
+
+def load():
+    '''
+    restore state from disk: load the latest utxo snapshot, then replay only the
+    blocks logged after it. blocks up to the snapshot are not validated again.
+
+    @return True if there was anything to load
+    '''
+    global _snapshot_height, _offsets
+
+    # imported here, block imports store
+    from noobcash.backend.block import Block
+
+    if not enabled() or not os.path.exists(_path(NODE)):
+        return False
+
+    with open(_path(NODE), 'r') as fin:
+        node = json.load(fin)
+
+    records = _read_log()
+    snap = _read_snapshot()
+
+    with state.lock:
+        state.privkey = node['privkey']
+        state.pubkey = node['pubkey']
+        state.token = node['token']
+        state.participant_id = node['participant_id']
+        state.participants = node['participants']
+        state.num_participants = len(state.participants)
+        state.other_hosts = [p['host'] for p in state.participants.values() if p['id'] != state.participant_id]
+
+        state.genesis_block = Block(**json.loads(node['genesis_block']), index=0)
+        state.genesis_utxos = UTXOSet.from_dict(node['genesis_utxos'])
+
+        # use the snapshot only if it matches the log
+        _snapshot_height = 0
+        state.valid_utxos = state.genesis_utxos.copy()
+        if snap is not None and 0 < snap['height'] <= len(records):
+            if json.loads(records[snap['height'] - 1][1]['block'])['current_hash'] == snap['hash']:
+                _snapshot_height = snap['height']
+                state.valid_utxos = UTXOSet.from_dict(snap['utxos'])
+
+        state.blockchain = [state.genesis_block]
+        _offsets = []
+        for offset, record in records:
+            previous = state.blockchain[-1]
+            block = Block(**json.loads(record['block']), index=previous.index + 1)
+
+            try:
+                block.target = Block.next_target(state.blockchain)
+                if block.previous_hash != previous.current_hash:
+                    raise Exception('block does not extend the chain')
+
+                if block.index <= _snapshot_height:
+                    # already in the snapshot utxos
+                    block.undo = UTXOView.from_changes(record['undo'])
+                else:
+                    block.verify(previous)
+                    block.apply(state.valid_utxos)
+
+            except Exception as e:
+                print(f'store.load: dropping blocks from {block.index}: {e.__class__.__name__}: {e}')
+                break
+
+            state.blockchain.append(block)
+            _offsets.append(offset)
+
+        state.blockchain_public = [b.dump_sendable().encode() for b in state.blockchain[1:]]
+        state.index = ChainIndex.from_chain(state.blockchain)
+
+        state.transactions = Mempool()
+        state.utxos = state.valid_utxos.overlay()
+
+        # drop anything after the last good block
+        log = _open_log()
+        if len(_offsets) < len(records):
+            log.truncate(records[len(_offsets)][0])
+            log.seek(records[len(_offsets)][0])
+
+    print(f'store.load: participant {state.participant_id}, {len(state.blockchain)} blocks, '
+          f'replayed {len(state.blockchain) - 1 - _snapshot_height} after snapshot')
+    return True
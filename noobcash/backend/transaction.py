@@ -1,14 +1,76 @@
 # transaction.py
 
-import copy
+import os
 import json
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
 
 from Crypto.Hash import SHA384
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 import base64
 
-from noobcash.backend import state, miner, settings
+from noobcash.backend import state, settings, metrics, events
+
+################################################################################
+
+class MissingInputs(Exception):
+    '''the inputs of a transaction are not utxos: spent, or from a transaction we do not have (yet)'''
+
+################################################################################
+
+@functools.lru_cache(maxsize=settings.KEY_CACHE_SIZE)
+def _import_key(pem):
+    '''parse RSA key, cached so that the PEM of each participant is parsed only once'''
+    return RSA.importKey(pem)
+
+
+def _verify(sender, tx_dump, signature):
+    '''check `signature` of the transaction dumped in `tx_dump`. runs in worker processes as well'''
+    try:
+        verifier = PKCS1_v1_5.new(_import_key(sender))
+        return verifier.verify(SHA384.new(tx_dump.encode()), base64.b64decode(signature))
+    except Exception as e:
+        print(f'verify_signature: {e.__class__.__name__}: {e}')
+        return False
+
+
+# Signatures verified so far, `_verified[(id, signature)] = True`, least recently used first
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+def _is_verified(key):
+    with _verified_lock:
+        if key in _verified:
+            _verified.move_to_end(key)
+            return True
+
+        return False
+
+
+def _set_verified(key):
+    with _verified_lock:
+        _verified[key] = True
+        if len(_verified) > settings.SIGNATURE_CACHE_SIZE:
+            _verified.popitem(last=False)
+
+
+# Worker processes for verifying signatures of large blocks
+_pool = None
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.VERIFY_PROCESSES or os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    return _pool
+
+################################################################################
 
 class Transaction(object):
     '''
@@ -23,19 +85,36 @@ class Transaction(object):
 
     'outputs': utxos for sender and recepient [{transaction_id, who, amount}]
     'signature': hash signed by sender private key
+
+    once signed, a transaction cannot be changed, and its json strings are cached
     '''
 
+    __slots__ = ('sender', 'recepient', 'amount', 'inputs', 'id', 'signature', 'outputs', '_dump', '_sendable')
+
+    # fixed once the transaction is signed
+    FIELDS = ('sender', 'recepient', 'amount', 'inputs', 'id', 'signature')
+
     def __init__(self, sender, recepient, amount, inputs, id=None, signature=None):
         '''init'''
         self.sender = sender
         self.recepient = recepient
         self.amount = amount
-        self.inputs = inputs
+        self.inputs = tuple(inputs)
 
         self.id = id
         self.signature = signature
         self.outputs = []
 
+        self._dump = None
+        self._sendable = None
+
+
+    def __setattr__(self, name, value):
+        if name in Transaction.FIELDS and getattr(self, 'signature', None) is not None:
+            raise AttributeError(f'transaction is signed, cannot change {name}')
+
+        object.__setattr__(self, name, value)
+
 
     def __eq__(self, o):
         ''' equality check, needed for comparing when removing/adding to list '''
@@ -47,14 +126,14 @@ class Transaction(object):
 
     def dump_sendable(self):
         '''convert to sendable json string'''
-        return json.dumps(dict(
-            sender=self.sender,
-            recepient=self.recepient,
-            amount=self.amount,
-            inputs=self.inputs,
-            id=self.id,
-            signature=self.signature
-        ), sort_keys=True)
+        if self._sendable is not None:
+            return self._sendable
+
+        sendable = json.dumps(self.dict(), sort_keys=True)
+        if self.signature is not None:
+            self._sendable = sendable
+
+        return sendable
 
     def dict(self):
         '''convert to dict'''
@@ -70,12 +149,19 @@ class Transaction(object):
 
     def dump(self):
         '''convert to json string to calculate hash'''
-        return json.dumps(dict(
+        if self._dump is not None:
+            return self._dump
+
+        dump = json.dumps(dict(
             sender=self.sender,
             recepient=self.recepient,
             amount=self.amount,
             inputs=self.inputs,
             ), sort_keys=True)
+        if self.signature is not None:
+            self._dump = dump
+
+        return dump
 
 
     def calculate_hash(self):
@@ -87,7 +173,7 @@ class Transaction(object):
         '''sign a transaction using our private key'''
         hash_obj = self.calculate_hash()
 
-        rsa_key = RSA.importKey(state.privkey)
+        rsa_key = _import_key(state.privkey)
         signer = PKCS1_v1_5.new(rsa_key)
 
         self.id = hash_obj.hexdigest()
@@ -95,102 +181,175 @@ class Transaction(object):
 
 
     def verify_signature(self):
-        '''verify the signature of an incoming transaction'''
-        try:
-            rsa_key = RSA.importKey(self.sender.encode())
-            verifier = PKCS1_v1_5.new(rsa_key)
+        '''
+        verify the signature of an incoming transaction.
+        valid signatures are cached by transaction id, so a transaction that is
+        validated again (e.g. when it enters a block) is only checked once
+        '''
+        key = (self.calculate_hash().hexdigest(), self.signature)
+        if _is_verified(key):
+            return True
 
-            hash_obj = self.calculate_hash()
-            return verifier.verify(hash_obj, base64.b64decode(self.signature))
-        except Exception as e:
-            print(f'verify_signature: {e.__class__.__name__}: {e}')
+        if not _verify(self.sender, self.dump(), self.signature):
             return False
 
+        _set_verified(key)
+        return True
+
 
     @staticmethod
+    def verify_signatures(transactions):
+        '''
+        verify the signatures of many transactions, e.g. the transactions of a block.
+        if there are enough of them, signatures that are not cached are checked in
+        parallel by a pool of worker processes
+
+        @return list of True/False, for each transaction
+        '''
+        keys = [(t.calculate_hash().hexdigest(), t.signature) for t in transactions]
+        todo = [i for i, key in enumerate(keys) if not _is_verified(key)]
+
+        if len(todo) < settings.PARALLEL_VERIFY_MIN:
+            return [t.verify_signature() for t in transactions]
+
+        result = [True] * len(transactions)
+        futures = [_get_pool().submit(_verify, transactions[i].sender, transactions[i].dump(), transactions[i].signature) for i in todo]
+        for i, future in zip(todo, futures):
+            result[i] = future.result()
+            if result[i]:
+                _set_verified(keys[i])
+
+        return result
+
+
+    def apply(self, utxos):
+        '''
+        check that the transaction is valid against `utxos`, then spend its inputs
+        and add its outputs to `utxos`. raises an Exception if the transaction is invalid,
+        in which case `utxos` is not altered.
+        '''
+        if self.sender == self.recepient:
+            raise Exception('sender must be different from recepient')
+        if self.sender not in state.participants:
+            raise Exception('unknown sender')
+        if self.recepient not in state.participants:
+            raise Exception('unknown recepient')
+
+        if not isinstance(self.id, str):
+            raise Exception('invalid hash type')
+        if not isinstance(self.signature, str):
+            raise Exception('invalid signature type')
+        if self.amount <= 0:
+            raise Exception('negative amount?')
+        if self.id != self.calculate_hash().hexdigest():
+            raise Exception('invalid hash')
+
+        # verify signature
+        if not self.verify_signature():
+            raise Exception('invalid signature')
+
+        # verify that transaction inputs are unique
+        if len(set(self.inputs)) != len(self.inputs):
+            raise Exception('duplicate inputs')
+
+        # assert that it is not using itself as input
+        if self.id in self.inputs:
+            raise Exception('invalid inputs')
+
+        # verify that inputs are utxos
+        budget = 0
+        for txin_id in self.inputs:
+            amount = utxos.get(txin_id, self.sender)
+            if amount is None:
+                raise MissingInputs('missing transaction inputs')
+
+            budget += amount
+
+        # verify money is enough
+        if budget < self.amount:
+            raise Exception('not enough money')
+
+        # create outputs
+        self.outputs = [{
+            'id': self.id,
+            'who': self.sender,
+            'amount': budget - self.amount
+        }, {
+            'id': self.id,
+            'who': self.recepient,
+            'amount': self.amount
+        }]
+
+        # update utxos, this is final
+        for txin_id in self.inputs:
+            utxos.spend(txin_id, self.sender)
+        utxos.add(self.outputs[0])
+        utxos.add(self.outputs[1])
+
+
+    def validate(self):
+        '''
+        validate against the latest utxos and add to the pending transactions
+
+        @return 'added'/'exists', raises an Exception if the transaction is invalid
+        '''
+        with state.lock:
+            if self in state.transactions or self.id in state.index.transactions:
+                return 'exists'
+
+            self.apply(state.utxos)
+            state.transactions.add(self)
+
+        return 'added'
+
+
+    def emit_accepted(self):
+        '''new pending transaction, see `events`'''
+        events.emit('transaction', tx_id=self.id, amount=self.amount,
+                    sender_id=state.participants[self.sender]['id'],
+                    recepient_id=state.participants[self.recepient]['id'])
+
+
+    def replay(self):
+        '''
+        validate a pending transaction again, e.g. after a new block changed the utxos.
+        If it fails, sender is fraudulent (or lost a race), but oh well
+        '''
+        try:
+            return self.validate()
+        except Exception as e:
+            print(f'Transaction.replay: {e.__class__.__name__}: {e}')
+            return 'error'
+
+
+    @staticmethod
+    @metrics.validate_transaction.time()
     def validate_transaction(json_string):
         '''
-        * validate an incoming transaction
+        * validate an incoming transaction (json string, or Transaction decoded from the wire)
         * add to list of transactions
         * start miner if requested/needed
 
         IMPORTANT NOTE: global state is not altered in case of an invalid transaction
 
-        @return (('added'/'exists'), transaction) OR ('error', None)
+        @return (('added'/'exists'), transaction) OR ('orphan', transaction) if we do not
+        have its inputs (yet) OR ('error', None)
         '''
         try:
-            t = Transaction(**json.loads(json_string))
-
-            with state.lock:
-                if t in state.transactions:
-                    return 'exists', t
-
-                if t.sender == t.recepient:
-                    raise Exception('sender must be different from recepient')
-                if t.sender not in state.participants:
-                    raise Exception('unknown sender')
-                if t.recepient not in state.participants:
-                    raise Exception('unknown recepient')
-
-                if not isinstance(t.id, str):
-                    raise Exception('invalid hash type')
-                if not isinstance(t.signature, str):
-                    raise Exception('invalid signature type')
-                if t.amount <= 0:
-                    raise Exception('negative amount?')
-                if t.id != t.calculate_hash().hexdigest():
-                    raise Exception('invalid hash')
-
-                # verify signature
-                if not t.verify_signature():
-                    raise Exception('invalid signature')
-
-                # verify that transaction inputs are unique
-                if len(set(t.inputs)) != len(t.inputs):
-                    raise Exception('duplicate inputs')
-
-                # assert that it is not using itself as input
-                if t.id in t.inputs:
-                    raise Exception('invalid inputs')
-
-                # verify that inputs are utxos
-                sender_utxos = copy.deepcopy(state.utxos[t.sender])
-                budget = 0
-                for txin_id in t.inputs:
-                    found = False
-
-                    for utxo in sender_utxos:
-                        if utxo['id'] == txin_id and utxo['who'] == t.sender:
-                            found = True
-                            budget += utxo['amount']
-                            sender_utxos.remove(utxo)
-                            break
-
-                    if not found:
-                        raise Exception('missing transaction inputs')
-
-                # verify money is enough
-                if budget < t.amount:
-                    raise Exception('not enough money')
+            if isinstance(json_string, Transaction):
+                t = json_string
+            else:
+                t = Transaction(**json.loads(json_string))
 
-                # create outputs
-                t.outputs = [{
-                    'id': t.id,
-                    'who': t.sender,
-                    'amount': budget - t.amount
-                }, {
-                    'id': t.id,
-                    'who': t.recepient,
-                    'amount': t.amount
-                }]
+            res = t.validate()
+            if res == 'added':
+                t.emit_accepted()
 
-                # update utxos, this is final
-                sender_utxos.append(t.outputs[0])
-                state.utxos[t.sender] = sender_utxos
-                state.utxos[t.recepient].append(t.outputs[1])
-                state.transactions.append(t)
+            return res, t
 
-            return 'added', t
+        except MissingInputs:
+            # e.g. relayed before the transaction it spends, see `views/receive.py`
+            return 'orphan', t
 
         except Exception as e:
             print(f'Transaction.validate_transaction: {e.__class__.__name__}: {e}')
@@ -215,11 +374,8 @@ class Transaction(object):
             amount = float(amount)
 
             with state.lock:
-                sender_utxos = copy.deepcopy(state.utxos[sender])
-                recepient_utxos = copy.deepcopy(state.utxos[recepient])
-
-                inputs = [tx['id'] for tx in sender_utxos]
-                budget = sum(tx['amount'] for tx in sender_utxos if tx['who'] == sender)
+                inputs = state.utxos.ids(sender)
+                budget = state.utxos.balance(sender)
 
                 if budget < amount:
                     raise Exception('not enough money')
@@ -237,10 +393,13 @@ class Transaction(object):
                     'amount': amount
                 }]
 
-                state.utxos[sender] = [t.outputs[0]]
-                state.utxos[recepient].append(t.outputs[1])
+                for txin_id in inputs:
+                    state.utxos.spend(txin_id, sender)
+                state.utxos.add(t.outputs[0])
+                state.utxos.add(t.outputs[1])
 
-                state.transactions.append(t)
+                state.transactions.add(t)
+                t.emit_accepted()
 
             return t
 
@@ -249,6 +408,15 @@ class Transaction(object):
             return None
 
 
+    @staticmethod
+    def create_transactions(requested):
+        '''
+        create many transactions, `requested` is a list of `{recepient, amount}`
+        @return list of the transaction objects, None for each one that failed
+        '''
+        return [Transaction.create_transaction(r.get('recepient'), r.get('amount')) for r in requested]
+
+
     @staticmethod
     def create_genesis_transaction(num_participants):
         '''the one transaction to rule them all'''
@@ -268,8 +436,8 @@ class Transaction(object):
             }]
 
             with state.lock:
-                state.utxos[state.pubkey] = [t.outputs[0]]
-                state.transactions.append(t)
+                state.utxos.add(t.outputs[0])
+                state.transactions.add(t)
 
             return True
         except Exception as e:
@@ -0,0 +1,206 @@
+# utxo.py
+
+class UTXOSet(object):
+    '''
+    Unspent transaction outputs, indexed by owner and transaction id.
+
+    `_utxos[who][id] = amount`
+    `_balance[who] = sum of amounts of who`
+
+    lookup, add and spend are O(1), balance is kept as a running total
+    '''
+
+    def __init__(self):
+        self._utxos = {}
+        self._balance = {}
+
+
+    def add_owner(self, who):
+        '''make sure `who` is known, even with no utxos'''
+        self._utxos.setdefault(who, {})
+        self._balance.setdefault(who, 0)
+
+
+    def get(self, id, who):
+        '''amount of utxo `(id, who)`, or None if there is no such utxo'''
+        return self._utxos.get(who, {}).get(id)
+
+
+    def add(self, utxo):
+        '''add an output `{id, who, amount}`'''
+        self.add_owner(utxo['who'])
+        self._utxos[utxo['who']][utxo['id']] = utxo['amount']
+        self._balance[utxo['who']] += utxo['amount']
+
+
+    def spend(self, id, who):
+        '''remove utxo `(id, who)`, return its amount'''
+        amount = self._utxos[who].pop(id)
+        self._balance[who] -= amount
+        return amount
+
+
+    def balance(self, who):
+        '''total amount of utxos of `who`'''
+        return self._balance.get(who, 0)
+
+
+    def ids(self, who):
+        '''ids of transactions with utxos for `who`'''
+        return list(self._utxos.get(who, {}))
+
+
+    def owners(self):
+        return list(self._utxos)
+
+
+    def __len__(self):
+        return sum(len(x) for x in self._utxos.values())
+
+
+    def copy(self):
+        result = UTXOSet()
+        result._utxos = {who: dict(utxos) for who, utxos in self._utxos.items()}
+        result._balance = dict(self._balance)
+        return result
+
+
+    def dict(self):
+        '''convert to sendable dict `{who: [{id, who, amount}]}`'''
+        return {
+            who: [{'id': id, 'who': who, 'amount': amount} for id, amount in utxos.items()]
+            for who, utxos in self._utxos.items()
+        }
+
+
+    @staticmethod
+    def from_dict(d):
+        '''inverse of `dict()`'''
+        result = UTXOSet()
+        for who, utxos in d.items():
+            result.add_owner(who)
+            for utxo in utxos:
+                result.add(utxo)
+
+        return result
+
+
+    def overlay(self):
+        '''start a copy-on-write view on top of this set, see `UTXOView`'''
+        return UTXOView(self)
+
+
+class UTXOView(object):
+    '''
+    Copy-on-write view of a `UTXOSet` (or of another view).
+
+    Changes are recorded in the view only, the parent is not touched:
+
+    `_added[who][id] = amount`   <-- utxos created in this view
+    `_spent[(id, who)] = amount` <-- utxos of the parent spent in this view
+    `_delta[who]`                <-- balance change of who
+
+    `commit()` pushes the changes to the parent, and dropping the view rolls
+    them back. Both cost O(changes), instead of copying the whole set.
+    '''
+
+    def __init__(self, parent):
+        self.parent = parent
+        self._added = {}
+        self._spent = {}
+        self._delta = {}
+
+
+    def get(self, id, who):
+        amount = self._added.get(who, {}).get(id)
+        if amount is not None:
+            return amount
+
+        if (id, who) in self._spent:
+            return None
+
+        return self.parent.get(id, who)
+
+
+    def add(self, utxo):
+        self._added.setdefault(utxo['who'], {})[utxo['id']] = utxo['amount']
+        self._delta[utxo['who']] = self._delta.get(utxo['who'], 0) + utxo['amount']
+
+
+    def spend(self, id, who):
+        if id in self._added.get(who, {}):
+            amount = self._added[who].pop(id)
+        else:
+            amount = self.parent.get(id, who)
+            if amount is None or (id, who) in self._spent:
+                raise KeyError((id, who))
+
+            self._spent[(id, who)] = amount
+
+        self._delta[who] = self._delta.get(who, 0) - amount
+        return amount
+
+
+    def balance(self, who):
+        return self.parent.balance(who) + self._delta.get(who, 0)
+
+
+    def ids(self, who):
+        spent = self._spent
+        result = [id for id in self.parent.ids(who) if (id, who) not in spent]
+        return result + list(self._added.get(who, {}))
+
+
+    def owners(self):
+        return self.parent.owners()
+
+
+    def __len__(self):
+        return len(self.parent) - len(self._spent) + sum(len(x) for x in self._added.values())
+
+
+    def overlay(self):
+        return UTXOView(self)
+
+
+    def commit(self):
+        '''apply changes to the parent'''
+        for (id, who) in self._spent:
+            self.parent.spend(id, who)
+
+        for who, utxos in self._added.items():
+            for id, amount in utxos.items():
+                self.parent.add({'id': id, 'who': who, 'amount': amount})
+
+        # the view is only kept around as an undo log from now on
+        self.parent = None
+
+
+    def revert(self, utxos):
+        '''undo the changes of this (committed) view on `utxos`'''
+        for who, added in self._added.items():
+            for id in added:
+                utxos.spend(id, who)
+
+        for (id, who), amount in self._spent.items():
+            utxos.add({'id': id, 'who': who, 'amount': amount})
+
+
+    def changes(self):
+        '''convert changes to sendable dict `{added: [[id, who, amount]], spent: [[id, who, amount]]}`'''
+        return {
+            'added': [[id, who, amount] for who, added in self._added.items() for id, amount in added.items()],
+            'spent': [[id, who, amount] for (id, who), amount in self._spent.items()]
+        }
+
+
+    @staticmethod
+    def from_changes(d):
+        '''inverse of `changes()`, for a view that is already committed'''
+        result = UTXOView(None)
+        for id, who, amount in d['added']:
+            result._added.setdefault(who, {})[id] = amount
+        for id, who, amount in d['spent']:
+            result._spent[(id, who)] = amount
+
+        return result
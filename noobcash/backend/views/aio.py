@@ -0,0 +1,296 @@
+# aio.py
+# Async versions of the views, served by `noobcash/asgi.py`. These are function
+# views, Django 3.2 does not support async class-based views.
+#
+# Read-only views only look at the latest snapshot, so they never block. Changes
+# to the state are handed to the writer and awaited, and requests to other
+# participants (consensus, missing transactions of compact blocks) use an async
+# HTTP client (`httpx`, if installed), so that a participant does not need a thread
+# for each open connection. Messages to other participants are sent by the per-peer
+# queues of `broadcast.py` (one worker thread per peer, shared with the sync views).
+
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, JsonResponse
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from noobcash.backend.transaction import Transaction
+from noobcash.backend import consensus, gossip, settings, state, miner, writer
+from noobcash.backend.views import send, receive
+
+################################################################################
+
+async def run(fn, *args):
+    '''run `fn(*args)` on the writer, without blocking the event loop'''
+    return await asyncio.wrap_future(writer.post(fn, *args))
+
+
+_client = None
+
+def client():
+    '''async HTTP client for requests to other participants, None if httpx is not installed'''
+    global _client
+    if _client is None and httpx is not None:
+        _client = httpx.AsyncClient()
+
+    return _client
+
+
+async def run_consensus():
+    '''ask all participants for their chain, see `consensus.consensus()`'''
+    if client() is None:
+        return await sync_to_async(consensus.consensus, thread_sensitive=False)()
+
+    await consensus.consensus_async(client())
+
+
+async def fetch_transactions(compact, transactions):
+    '''get the transactions of a compact block we do not have, see `receive.fetch_transactions()`'''
+    if client() is None:
+        return await sync_to_async(receive.fetch_transactions, thread_sensitive=False)(compact, transactions)
+
+    missing, url, params = receive.missing_transactions(compact, transactions)
+    if not missing:
+        return receive.block_fields(compact, transactions)
+
+    response = await client().get(url, params=params, timeout=settings.CONSENSUS_TIMEOUT)
+    return receive.block_fields(compact, transactions, missing, response)
+
+################################################################################
+
+async def create_transaction(request):
+    '''
+    Create a transaction and announce it to other participants.
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    recepient = request.POST.get('recepient')
+    amount = request.POST.get('amount')
+    token = request.POST.get('token')
+
+    if state.token != token:
+        return HttpResponseBadRequest('invalid token')
+
+    res = await run(Transaction.create_transaction, recepient, amount)
+    if res is None:
+        return HttpResponseBadRequest('invalid transaction')
+
+    gossip.announce(transactions=[res])
+
+    await run(miner.start_if_needed)
+
+    return HttpResponse()
+
+
+async def create_transactions(request):
+    '''
+    Create many transactions and announce them in one message, see `CreateAndSendTransactions`
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    token = request.POST.get('token')
+    if state.token != token:
+        return HttpResponseBadRequest('invalid token')
+
+    try:
+        requested = send.read_requested(request)
+    except Exception as e:
+        return HttpResponseBadRequest(f'invalid request: {e}')
+
+    res = await run(Transaction.create_transactions, requested)
+    created = [t for t in res if t is not None]
+    if created:
+        gossip.announce(transactions=created)
+
+    await run(miner.start_if_needed)
+
+    return JsonResponse({'transactions': [t.id if t is not None else None for t in res]})
+
+
+async def receive_transaction(request):
+    '''
+    View that receives a new transaction from another client, see `ReceiveTransaction`
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        trans_json_string = receive.read_transaction(request)
+    except Exception as e:
+        return HttpResponseBadRequest(f'invalid message: {e}')
+
+    res = await run(receive.receive_transaction, trans_json_string)
+
+    status = 200 if res != 'error' else 400
+    return HttpResponse(res, status=status)
+
+
+async def receive_transactions(request):
+    '''
+    View that receives many transactions from another client, see `ReceiveTransactions`
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        transactions = receive.read_transactions(request)
+    except Exception as e:
+        return HttpResponseBadRequest(f'invalid message: {e}')
+
+    await sync_to_async(Transaction.verify_signatures, thread_sensitive=False)(transactions)
+    results = await run(receive.receive_transactions, transactions)
+
+    return JsonResponse({'results': results})
+
+
+async def receive_block(request):
+    '''
+    View that receives a new block from another client, see `ReceiveBlock`
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        block_json_string = receive.read_block(request)
+    except Exception as e:
+        return HttpResponseBadRequest(f'invalid message: {e}')
+
+    return await _receive_block(block_json_string)
+
+
+async def receive_compact_block(request):
+    '''
+    View that receives a new block as transaction ids, see `ReceiveCompactBlock`
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        compact = receive.read_compact_block(request)
+    except Exception as e:
+        return HttpResponseBadRequest(f'invalid message: {e}')
+
+    if state.snapshot.block(compact['current_hash']) is not None:
+        return HttpResponse('dropped')
+
+    try:
+        fields = await fetch_transactions(compact, receive.find_transactions(compact['tx_ids']))
+    except receive.NotServed as e:
+        # e.g. the sender switched to another chain since, catch up with everyone
+        print(f'receive_compact_block/: {e.__class__.__name__}: {e}')
+        if not receive.catch_up_allowed(compact):
+            return HttpResponseBadRequest('invalid proof of work')
+
+        await run(miner.stop)
+        receive.block_received('consensus')
+        await run_consensus()
+        await run(miner.start_if_needed)
+        return HttpResponse('consensus')
+    except Exception as e:
+        print(f'receive_compact_block/: {e.__class__.__name__}: {e}')
+        return HttpResponse('could not fetch missing transactions', status=502)
+
+    return await _receive_block(fields)
+
+
+async def receive_inventory(request):
+    '''
+    View that receives the ids of new transactions, see `ReceiveInventory`
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        wanted = gossip.wanted(json.loads(request.POST.get('inv')))
+    except Exception as e:
+        return HttpResponseBadRequest(f'invalid message: {e}')
+
+    return JsonResponse(wanted)
+
+
+async def _receive_block(block_json_string):
+    await run(miner.stop)
+    res = await run(receive.validate_block, block_json_string)
+
+    if res == 'error':
+        # the pending transactions still need a block
+        await run(miner.start_if_needed)
+        return HttpResponseBadRequest(res)
+
+    # consensus asks all participants at the same time
+    receive.block_received(res)
+    if res == 'ok':
+        receive.relay_block(block_json_string)
+    elif res == 'consensus':
+        await run_consensus()
+
+    await run(miner.start_if_needed)
+
+    return HttpResponse(res)
+
+################################################################################
+
+def read_only(view):
+    '''async version of a read-only class-based view. these only read the latest snapshot'''
+    sync_view = view.as_view()
+
+    async def async_view(request, *args, **kwargs):
+        return sync_view(request, *args, **kwargs)
+
+    return async_view
+
+
+def in_thread(view):
+    '''
+    async version of a sync class-based view, run in a thread of its own. Django runs
+    sync views one at a time, which deadlocks views that wait for another participant
+    calling us back (e.g. init_client/ waits for client_accepted/)
+    '''
+    sync_view = view.as_view()
+
+    async def async_view(request, *args, **kwargs):
+        return await sync_to_async(sync_view, thread_sensitive=False)(request, *args, **kwargs)
+
+    return async_view
+
+
+get_blockchain = read_only(send.GetBlockchain)
+get_blockchain_length = read_only(send.GetBlockchainLength)
+get_headers = read_only(send.GetHeaders)
+get_block = read_only(send.GetBlock)
+get_block_transactions = read_only(send.GetBlockTransactions)
+get_transaction = read_only(send.GetTransaction)
+get_history = read_only(send.GetHistory)
+get_balance = read_only(send.GetBalance)
+get_balance_latest = read_only(send.GetLatestBalance)
+get_transactions = read_only(send.GetTransactions)
+get_transactions_all = read_only(send.GetAllTransactions)
+get_num_blocks_created = read_only(send.GetTotalBlocksCreated)
+get_num_pending_transactions = read_only(send.GetNumPendingTransactions)
+get_pending_transactions = read_only(send.GetPendingTransactions)
+get_peer_stats = read_only(send.GetPeerStats)
+get_metrics = read_only(send.GetMetrics)
+
+
+async def get_events(request):
+    '''
+    Long-poll for new blocks, transactions and forks, see `GetEvents`. Always long-poll,
+    Django 3.2 cannot stream from async views.
+    '''
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    try:
+        since, since_height, timeout = send.read_events_request(request)
+    except ValueError:
+        return HttpResponseBadRequest('invalid since, since_height or timeout')
+
+    return JsonResponse(await sync_to_async(send.poll_events, thread_sensitive=False)(since, since_height, timeout))
@@ -1,7 +1,7 @@
 # connect.py
 
-import copy
 import json
+import threading
 import requests
 
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseServerError, JsonResponse
@@ -9,7 +9,9 @@ from django.views import View
 
 from noobcash.backend.transaction import Transaction
 from noobcash.backend.block import Block
-from noobcash.backend import state, keypair, broadcast, settings, miner
+from noobcash.backend.utxo import UTXOSet
+from noobcash.backend.index import ChainIndex
+from noobcash.backend import state, keypair, broadcast, gossip, settings, miner, wire, store, writer
 
 ################################################################################
 
@@ -18,13 +20,17 @@ class InitAsClient(View):
     def post(self, request):
         host = request.POST.get('host')
 
-        with state.lock:
+        def init():
             # too safe
             if state.token:
-                return HttpResponseBadRequest()
+                return False
 
             # hit the coordinator jack
             keypair.generate_keypair()
+            return True
+
+        if not writer.submit(init):
+            return HttpResponseBadRequest()
 
         api = f'{settings.COORDINATOR}/client_connect/'
         data = {
@@ -49,7 +55,7 @@ class InitAsServer(View):
             return HttpResponseBadRequest('need >= 2 participants')
 
         # we are totally safe now
-        with state.lock:
+        def init():
             # only once
             if state.pubkey:
                 return HttpResponseBadRequest()
@@ -58,15 +64,17 @@ class InitAsServer(View):
 
             state.num_participants = count
             state.participant_id = 0
-            state.utxos = { }
-            state.utxos[state.pubkey] = []
+            state.utxos = UTXOSet()
+            state.utxos.add_owner(state.pubkey)
 
             state.participants[state.pubkey] = {
                 'host': host,
                 'id': state.participant_id
             }
 
-        return HttpResponse(state.token)
+            return HttpResponse(state.token)
+
+        return writer.submit(init)
 
 
 class ClientConnect(View):
@@ -76,7 +84,7 @@ class ClientConnect(View):
         pubkey = request.POST.get('pubkey')
 
         # safe as a kite
-        with state.lock:
+        def connect():
             if state.num_participants == -1 or state.participant_id != 0 or pubkey in state.participants:
                 return HttpResponseBadRequest()
 
@@ -85,7 +93,7 @@ class ClientConnect(View):
                 'host': host,
                 'id': next_id
             }
-            state.utxos[pubkey] = []
+            state.utxos.add_owner(pubkey)
 
             # all clients connected, send out 'accepted' messages
             if len(state.participants) == state.num_participants:
@@ -97,33 +105,43 @@ class ClientConnect(View):
                 if not Block.create_genesis_block(state.num_participants):
                     return HttpResponseBadRequest()
 
+                store.save_node()
+
+                # tell everyone at the same time, one connection each
+                accepted = {
+                    'participants': json.dumps(state.participants),
+                    'genesis_block': state.blockchain[0].dump_sendable(),
+                    'genesis_utxos': json.dumps(state.genesis_utxos.dict())
+                }
+                waiting = []
                 for p in state.participants.values():
                     if p['id'] == state.participant_id:
                         continue
 
-                    requests.post(p['host'] + '/client_accepted/', {
-                        'participant_id': p['id'],
-                        'participants': json.dumps(state.participants),
-                        'genesis_block': state.blockchain[0].dump_sendable(),
-                        'genesis_utxos': json.dumps(state.utxos)
-                    })
-
-                # after everyone has connected, send transactions
-                # print(json.dumps(state.participants, indent=4))
-                for pubkey in state.participants:
-                    if pubkey == state.pubkey:
-                        continue
+                    done = threading.Event()
+                    broadcast.peer(p['host']).send('client_accepted', dict(accepted, participant_id=p['id']), done=done)
+                    waiting.append(done)
+
+                for done in waiting:
+                    done.wait()
 
-                    res = Transaction.create_transaction(pubkey, 100)
-                    if not res:
-                        return HttpResponseServerError()
+                # after everyone has connected, send transactions, in one message
+                created = Transaction.create_transactions([
+                    {'recepient': recepient, 'amount': 100}
+                    for recepient in state.participants if recepient != state.pubkey
+                ])
+                if not all(created):
+                    return HttpResponseServerError()
 
-                    broadcast.broadcast('receive_transaction', {'transaction': res.dump_sendable()}, wait=True)
+                gossip.mark_seen([t.id for t in created])
+                broadcast.broadcast('receive_transactions', wire.transactions_message(created), wait=True)
 
                 miner.start_if_needed()
 
             return HttpResponse()
 
+        return writer.submit(connect)
+
 
 class ClientAccepted(View):
     '''CLIENT ONLY'''
@@ -131,10 +149,10 @@ class ClientAccepted(View):
         participant_id = int(request.POST.get('participant_id'))
         participants = json.loads(request.POST.get('participants'))
         genesis_block_json = request.POST.get('genesis_block')
-        genesis_utxos = json.loads(request.POST.get('genesis_utxos'))
+        genesis_utxos = UTXOSet.from_dict(json.loads(request.POST.get('genesis_utxos')))
 
         # print('accepted', request.POST)
-        with state.lock:
+        def accept():
             if len(state.participants) > 0:
                 return HttpResponseBadRequest()
 
@@ -147,13 +165,17 @@ class ClientAccepted(View):
 
             # initial blockchain contains genesis block
             # DISCUSS: we just `logged in`, do we trust him or should we check
-            state.utxos = copy.deepcopy(genesis_utxos)
             state.blockchain = [Block(**json.loads(genesis_block_json), index=0)]
-            state.valid_utxos = copy.deepcopy(state.utxos)
+            state.index = ChainIndex.from_chain(state.blockchain)
+            state.valid_utxos = genesis_utxos.copy()
+            state.utxos = state.valid_utxos.overlay()
 
             # keep a backup of the genesis block and its utxos.
             # DISCUSS: this is to make validation easier when asking for consensus
-            state.genesis_utxos = copy.deepcopy(genesis_utxos)
+            state.genesis_utxos = genesis_utxos
             state.genesis_block = Block(**json.loads(genesis_block_json), index=0)
 
-        return HttpResponse()
+            store.save_node()
+            return HttpResponse()
+
+        return writer.submit(accept)
@@ -1,12 +1,234 @@
-import requests
 import json
+import requests
 
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.views import View
 
 from noobcash.backend.transaction import Transaction
-from noobcash.backend.block import Block
-from noobcash.backend import consensus, settings, state, miner
+from noobcash.backend.block import Block, easiest_target
+from noobcash.backend import consensus, gossip, settings, state, metrics, miner, wire, writer
+
+
+def read_transaction(request):
+    '''@return the transaction in the body of `request` (binary or form field)'''
+    if wire.is_binary(request):
+        return wire.decode_transaction(request.body)
+
+    return request.POST.get('transaction')
+
+
+def read_transactions(request):
+    '''@return list of the transactions in the body of `request` (binary or form field)'''
+    if wire.is_binary(request):
+        transactions = wire.decode_transactions(request.body)
+    else:
+        transactions = [Transaction(**json.loads(tx_json)) for tx_json in json.loads(request.POST.get('transactions'))]
+
+    if len(transactions) > settings.MAX_BATCH_SIZE:
+        raise Exception('too many transactions')
+
+    return transactions
+
+
+def read_block(request):
+    '''@return the block in the body of `request` (binary or form field)'''
+    if wire.is_binary(request):
+        return wire.decode_block(request.body)
+
+    return request.POST.get('block')
+
+
+def read_compact_block(request):
+    '''@return dict of the compact block in the body of `request`, see `wire.compact_block()`'''
+    if wire.is_binary(request):
+        compact = wire.decode_compact_block(request.body)
+    else:
+        compact = json.loads(request.POST.get('block'))
+
+    if len(compact['tx_ids']) > settings.BLOCK_CAPACITY:
+        raise Exception('too many transactions')
+    if not all(isinstance(tx_id, str) for tx_id in compact['tx_ids']):
+        raise Exception('invalid transaction ids')
+
+    int(compact['current_hash'], 16)
+    sender_host(compact)
+
+    return compact
+
+
+class NotServed(Exception):
+    '''the sender of a compact block does not have it, e.g. it switched to another chain since'''
+
+
+def sender_host(compact):
+    '''host of the participant that sent a compact block, raises an Exception if unknown'''
+    for p in state.snapshot.participants.values():
+        if p['id'] == compact['participant_id']:
+            return p['host']
+
+    raise Exception('unknown participant')
+
+
+def catch_up_allowed(compact):
+    '''
+    a compact block we could not rebuild makes us ask everyone for their chain, if its
+    hash has the work of the easiest target reachable from our tip
+    '''
+    return int(compact['current_hash'], 16) < easiest_target(state.snapshot.blockchain[-1])
+
+
+def find_transactions(tx_ids):
+    '''json strings of pending transactions `tx_ids`, None for the ones we do not have'''
+    snapshot = state.snapshot
+    result = []
+    for tx_id in tx_ids:
+        t = snapshot.pending_transaction(tx_id)
+        result.append(t.dump_sendable() if t is not None else None)
+
+    return result
+
+
+def missing_transactions(compact, transactions):
+    '''
+    the `transactions` of a compact block that are None (we do not have them).
+    @return (positions, url, params) to get them from the participant that sent it
+    '''
+    missing = [i for i, tx_json in enumerate(transactions) if tx_json is None]
+    if not missing:
+        return missing, None, None
+
+    host = sender_host(compact)
+    return missing, f'{host}/get_block_transactions/{compact["current_hash"]}/', {'positions': ','.join(map(str, missing))}
+
+
+def block_fields(compact, transactions, missing=(), response=None):
+    '''
+    fill in the `missing` transactions of a compact block from the get_block_transactions/
+    `response`. @return dict of block fields, raises `NotServed` if the sender does not
+    have the block, or an Exception on other failures
+    '''
+    if missing:
+        if response.status_code == 404:
+            raise NotServed('sender does not have the block')
+        if response.status_code != 200:
+            raise Exception('could not fetch missing transactions')
+
+        metrics.peer_bytes.inc(len(response.content))
+        fetched = response.json()['transactions']
+        if len(fetched) != len(missing):
+            raise Exception('could not fetch missing transactions')
+
+        for i, tx_json in zip(missing, fetched):
+            transactions[i] = tx_json
+
+    # the block hash is checked when validating, this also checks the transactions
+    return dict(
+        timestamp=compact['timestamp'],
+        transactions=transactions,
+        nonce=compact['nonce'],
+        current_hash=compact['current_hash'],
+        previous_hash=compact['previous_hash']
+    )
+
+
+def fetch_transactions(compact, transactions):
+    '''
+    get the `transactions` of a compact block that are None (we do not have them) from
+    the participant that sent it. @return dict of block fields, raises an Exception on failure
+    '''
+    missing, url, params = missing_transactions(compact, transactions)
+    if not missing:
+        return block_fields(compact, transactions)
+
+    response = requests.get(url, params, timeout=settings.CONSENSUS_TIMEOUT)
+    return block_fields(compact, transactions, missing, response)
+
+
+def _validate(transactions):
+    '''
+    validate transactions, and the orphans waiting for them (see `gossip.add_orphan()`).
+    relay the new ones. @return status of each of `transactions`
+    '''
+    results = []
+    added = []
+    for t in transactions:
+        res, t = Transaction.validate_transaction(t)
+        results.append(res)
+        if res == 'added':
+            added.append(t)
+        elif res == 'exists':
+            gossip.mark_seen([t.id])
+        elif res == 'orphan':
+            gossip.add_orphan(t)
+
+    added.extend(_adopt_orphans([t.id for t in added]))
+    if added:
+        gossip.announce(transactions=added)
+
+    return results
+
+
+def _adopt_orphans(tx_ids):
+    '''validate the orphans spending outputs of transactions `tx_ids`. @return the ones added'''
+    added = []
+    tx_ids = list(tx_ids)
+    while tx_ids:
+        for orphan in gossip.take_orphans(tx_ids.pop()):
+            res, t = Transaction.validate_transaction(orphan)
+            if res == 'added':
+                added.append(t)
+                tx_ids.append(t.id)
+            elif res == 'orphan':
+                # spends other transactions we do not have either
+                gossip.add_orphan(t)
+
+    return added
+
+
+def receive_transaction(trans_json_string):
+    '''validate a transaction, relay it if new and start mining if needed. runs on the writer'''
+    res, = _validate([trans_json_string])
+
+    miner.start_if_needed()
+    return res
+
+
+def receive_transactions(transactions):
+    '''validate many transactions, relay the new ones, start mining once. runs on the writer'''
+    results = _validate(transactions)
+
+    miner.start_if_needed()
+    return results
+
+
+def validate_block(block_json_string):
+    '''see `Block.validate_block()`, also adopts the orphans the new block spends. runs on the writer'''
+    res = Block.validate_block(block_json_string)
+    if res == 'ok':
+        added = _adopt_orphans(t.id for t in state.blockchain[-1].parsed_transactions())
+        if added:
+            gossip.announce(transactions=added)
+
+    return res
+
+
+def relay_block(block_json_string):
+    '''announce a block we accepted (json string or dict of fields) to other participants'''
+    fields = block_json_string if isinstance(block_json_string, dict) else json.loads(block_json_string)
+    block = state.snapshot.block(fields['current_hash'])
+    if block is not None:
+        gossip.announce(blocks=[block])
+
+
+def block_received(res):
+    if res == 'consensus':
+        print('need consensus vote')
+
+    if res == 'ok':
+        print('block is ok')
+
+    if res == 'dropped':
+        print('dropping')
 
 
 class ReceiveTransaction(View):
@@ -15,15 +237,36 @@ class ReceiveTransaction(View):
     Everything is done in `validate_transaction()`
     '''
     def post(self, request):
-        trans_json_string = request.POST.get('transaction')
-        with state.lock:
-            res, t = Transaction.validate_transaction(trans_json_string)
-            miner.start_if_needed()
+        try:
+            trans_json_string = read_transaction(request)
+        except Exception as e:
+            return HttpResponseBadRequest(f'invalid message: {e}')
+
+        res = writer.submit(receive_transaction, trans_json_string)
 
         status = 200 if res != 'error' else 400
         return HttpResponse(res, status=status)
 
 
+class ReceiveTransactions(View):
+    '''
+    View that receives many transactions from another client, in one message.
+    Signatures are verified before the writer validates them (in parallel, for large batches)
+
+    @return {'results': [status of each transaction, see `validate_transaction()`]}
+    '''
+    def post(self, request):
+        try:
+            transactions = read_transactions(request)
+        except Exception as e:
+            return HttpResponseBadRequest(f'invalid message: {e}')
+
+        Transaction.verify_signatures(transactions)
+        results = writer.submit(receive_transactions, transactions)
+
+        return JsonResponse({'results': results})
+
+
 class ReceiveBlock(View):
     '''
     View that receives a new block from another client.
@@ -34,53 +277,94 @@ class ReceiveBlock(View):
     In general, consensus is gonna be pretty slow.
     '''
     def post(self, request):
-        block_json_string = request.POST.get('block')
+        try:
+            block_json_string = read_block(request)
+        except Exception as e:
+            return HttpResponseBadRequest(f'invalid message: {e}')
 
-        miner.stop()
-        keep_begging = False
-        with state.lock:
-            res = Block.validate_block(block_json_string)
+        return self.receive(block_json_string)
 
-            if res == 'error':
-                return HttpResponseBadRequest(res)
 
-            if res == 'consensus':
-                print('need consensus vote')
-                res = consensus.consensus()
+    @staticmethod
+    def receive(block_json_string):
+        '''validate a block (json string or dict of fields), @return the response'''
+        writer.submit(miner.stop)
+        res = writer.submit(validate_block, block_json_string)
 
-            if res == 'ok':
-                print('block is ok')
+        if res == 'error':
+            # the pending transactions still need a block
+            writer.submit(miner.start_if_needed)
+            return HttpResponseBadRequest(res)
 
-            if res == 'dropped':
-                print('dropping')
+        # asks other participants, without blocking the state while waiting for them
+        block_received(res)
+        if res == 'ok':
+            relay_block(block_json_string)
+        elif res == 'consensus':
+            consensus.consensus()
 
-            keep_begging = not miner.start_if_needed()
+        # mine whatever is left, now or once the seal deadline passes
+        writer.submit(miner.start_if_needed)
 
-        # DISCUSS: also do this when creating blocks?
-        # not the brightest idea
-        for h in state.other_hosts:
-            if not keep_begging:
-                break
+        return HttpResponse(res)
 
-            # we validated a block and now we have very few transactions
-            # hard-working beggars have no shame
-            print(f'receive_block/: begging {h} for transactions')
-            try:
-                response = requests.get(f'{h}/get_pending_transactions/')
-                if response.status_code != 200:
-                    raise Exception('begging failed')
 
-                new_transactions = json.loads(response.json()['transactions'])
+class ReceiveCompactBlock(View):
+    '''
+    View that receives a new block from another client, with transaction ids instead of
+    transactions (see `wire.compact_block()`). The block is rebuilt from our pending
+    transactions, the ones we do not have are fetched from the sender. Then, same as `ReceiveBlock`.
+    If the sender does not have the block anymore, all participants are asked for their chain instead
+    '''
+    def post(self, request):
+        try:
+            compact = read_compact_block(request)
+        except Exception as e:
+            return HttpResponseBadRequest(f'invalid message: {e}')
 
-                with state.lock:
-                    for tx_json in new_transactions:
-                        res, t = Transaction.validate_transaction(tx_json)
+        # relayed by more than one participant
+        if state.snapshot.block(compact['current_hash']) is not None:
+            return HttpResponse('dropped')
 
-                    keep_begging = not miner.start_if_needed()
-            except Exception as e:
-                print(f'receive_block/: {e.__class__.__name__}: {e}')
+        try:
+            fields = fetch_transactions(compact, find_transactions(compact['tx_ids']))
+        except NotServed as e:
+            # e.g. the sender switched to another chain since, catch up with everyone
+            print(f'receive_compact_block/: {e.__class__.__name__}: {e}')
+            if not catch_up_allowed(compact):
+                return HttpResponseBadRequest('invalid proof of work')
 
-        if keep_begging:
-            print(f'receive_block/: asked around, no one else has enough transactions')
+            return ReceiveCompactBlock.catch_up()
+        except Exception as e:
+            print(f'receive_compact_block/: {e.__class__.__name__}: {e}')
+            return HttpResponse('could not fetch missing transactions', status=502)
 
-        return HttpResponse(res)
+        return ReceiveBlock.receive(fields)
+
+
+    @staticmethod
+    def catch_up():
+        '''ask all participants for their chain, instead of a block we could not rebuild'''
+        writer.submit(miner.stop)
+        block_received('consensus')
+        consensus.consensus()
+        writer.submit(miner.start_if_needed)
+
+        return HttpResponse('consensus')
+
+
+class ReceiveInventory(View):
+    '''
+    View that receives the ids of new transactions another participant has (see
+    `gossip.py`), as json `{transactions: [ids]}` in field `inv`.
+
+    @return {'transactions': [...]}, the ones we have not accepted or asked for. The participant then
+    sends them to receive_transactions/
+    '''
+    def post(self, request):
+        try:
+            wanted = gossip.wanted(json.loads(request.POST.get('inv')))
+        except Exception as e:
+            return HttpResponseBadRequest(f'invalid message: {e}')
+
+        return JsonResponse(wanted)
@@ -1,79 +1,255 @@
 import json
+import hashlib
+import functools
 
-from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+)
 from django.views import View
 
 from noobcash.backend.transaction import Transaction
-from noobcash.backend.block import Block
-from noobcash.backend import broadcast, state, miner
+from noobcash.backend import broadcast, events, gossip, metrics, settings, state, miner, wire, writer
+
+# streamed responses of `get_blockchain/` and `events/`
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+EVENT_STREAM_CONTENT_TYPE = 'text/event-stream'
+
+# responses of `cached` views, `_cache[key] = (snapshot version, etag, content, content type)`
+_cache = {}
+
+
+def cached(get):
+    '''
+    decorator for `get()` of read-only views. the response is built once for each
+    version of the state (see `writer.Snapshot`), and has an ETag (hash of the content).
+    requests with a matching `If-None-Match` get 304 Not Modified
+    '''
+    @functools.wraps(get)
+    def wrapper(self, request, *args, **kwargs):
+        # read the version first, the response is built from this snapshot or a newer one
+        version = state.snapshot.version
+        key = (self.__class__.__name__, args, tuple(sorted(kwargs.items())))
+
+        entry = _cache.get(key)
+        if entry is None or entry[0] != version:
+            response = get(self, request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+            entry = (version, f'"{hashlib.sha1(response.content).hexdigest()}"', response.content, response['Content-Type'])
+            _cache[key] = entry
+
+        _, etag, content, content_type = entry
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type=content_type)
+
+        response['ETag'] = etag
+        return response
+
+    return wrapper
 
 
 class CreateAndSendTransaction(View):
     '''
-    Create a transaction and broadcast to all participants.
+    Create a transaction and announce it to other participants (see `gossip.py`).
     '''
     def post(self, request):
         recepient = request.POST.get('recepient')
         amount = request.POST.get('amount')
         token = request.POST.get('token')
 
-        with state.lock:
-            if state.token != token:
-                return HttpResponseBadRequest('invalid token')
+        if state.token != token:
+            return HttpResponseBadRequest('invalid token')
 
-            res = Transaction.create_transaction(recepient, amount)
-            if res is None:
-                return HttpResponseBadRequest('invalid transaction')
+        res = writer.submit(Transaction.create_transaction, recepient, amount)
+        if res is None:
+            return HttpResponseBadRequest('invalid transaction')
 
-        broadcast.broadcast('receive_transaction', {'transaction': res.dump_sendable()})
+        gossip.announce(transactions=[res])
 
-        miner.start_if_needed()
+        writer.submit(miner.start_if_needed)
 
         return HttpResponse()
 
 
-class CreateAndSendBlock(View):
+def read_requested(request):
+    '''@return list of `{recepient, amount}` in the `transactions` field of `request`'''
+    requested = json.loads(request.POST.get('transactions'))
+    if not isinstance(requested, list) or not all(isinstance(r, dict) for r in requested):
+        raise Exception('expected a list of {recepient, amount}')
+    if len(requested) > settings.MAX_BATCH_SIZE:
+        raise Exception('too many transactions')
+
+    return requested
+
+
+class CreateAndSendTransactions(View):
     '''
-    The miner uses this view to notify server that a correct nonce was found
-    The participant creates the block, appends to their own blockchain and broadcasts
+    Create many transactions (`transactions`, json list of `{recepient, amount}`)
+    and announce them to other participants in one message.
 
-    `create_block` will also make sure that the nonce is indeed correct
+    @return {'transactions': [id of each transaction, or null if it failed]}
     '''
     def post(self, request):
-        transactions = json.loads(request.POST.get('transactions'))
-        nonce = int(request.POST.get('nonce'))
-        sha = request.POST.get('sha')
         token = request.POST.get('token')
-        timestamp = request.POST.get('timestamp')
-
-        if token != state.token:
+        if state.token != token:
             return HttpResponseBadRequest('invalid token')
 
-        miner.stop()
+        try:
+            requested = read_requested(request)
+        except Exception as e:
+            return HttpResponseBadRequest(f'invalid request: {e}')
 
-        # FIXME: start miner after sending?
-        with state.lock:
-            res = Block.create_block(transactions, nonce, sha, timestamp)
-            miner.start_if_needed()
+        res = writer.submit(Transaction.create_transactions, requested)
+        created = [t for t in res if t is not None]
+        if created:
+            gossip.announce(transactions=created)
 
-            if res is None:
-                return HttpResponseBadRequest()
+        writer.submit(miner.start_if_needed)
 
-        broadcast.broadcast('receive_block', {'block': res.dump_sendable()})
-
-        return HttpResponse()
+        return JsonResponse({'transactions': [t.id if t is not None else None for t in res]})
 
 
 class GetBlockchain(View):
     '''
-    Return current blockchain
+    Return current blockchain, or `?limit=` blocks starting from index `?from_height=`.
+
+    Paginated requests (or requests that accept NDJSON) are streamed, one line
+    `{"height": index, "block": {...}}` per block. Blocks are already serialized.
     '''
     def get(self, request):
-        with state.blockchain_public_lock:
+        try:
             # DISCUSS: we do not include the genesis block
-            return JsonResponse({
-                'blockchain': json.dumps(state.blockchain_public)
-            })
+            start = max(int(request.GET.get('from_height', 1)), 1)
+            limit = request.GET.get('limit')
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            return HttpResponseBadRequest('invalid from_height or limit')
+
+        end = start + limit if limit is not None else None
+        snapshot = state.snapshot
+        blocks = snapshot.public(start, end)
+
+        if wire.accepts(request):
+            return HttpResponse(wire.encode_blocks(snapshot.blocks(start, end)), content_type=wire.CONTENT_TYPE)
+
+        paginated = 'from_height' in request.GET or 'limit' in request.GET
+        if paginated or NDJSON_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+            lines = (b'{"height": %d, "block": %s}\n' % (start + i, block) for i, block in enumerate(blocks))
+            return StreamingHttpResponse(lines, content_type=NDJSON_CONTENT_TYPE)
+
+        return JsonResponse({
+            'blockchain': json.dumps([block.decode() for block in blocks])
+        })
+
+
+class GetHeaders(View):
+    '''
+    Return headers of up to `?limit=` blocks (at most MAX_BATCH_SIZE) starting from
+    index `?from=`, used for consensus.
+
+    @return {'headers': [...], 'height': length of the chain, 'next': index to ask
+    for the next headers from, or null if there are no more}
+    '''
+    def get(self, request):
+        try:
+            start = max(int(request.GET.get('from', 0)), 0)
+            limit = min(int(request.GET.get('limit', settings.MAX_BATCH_SIZE)), settings.MAX_BATCH_SIZE)
+        except ValueError:
+            return HttpResponseBadRequest('invalid index or limit')
+
+        snapshot = state.snapshot
+        headers = [{
+            'index': block.index,
+            'current_hash': block.current_hash,
+            'previous_hash': block.previous_hash
+        } for block in snapshot.blocks(start, start + max(limit, 0))]
+
+        end = start + len(headers)
+        return JsonResponse({
+            'headers': headers,
+            'height': snapshot.height,
+            'next': end if end < snapshot.height else None
+        })
+
+
+class GetBlock(View):
+    '''
+    Return block with hash or index `block_id`
+    '''
+    def get(self, request, block_id):
+        snapshot = state.snapshot
+        block = snapshot.block(block_id)
+        if block is None and block_id.isdigit() and int(block_id) < snapshot.height:
+            block = snapshot.blockchain[int(block_id)]
+
+        if block is None:
+            return HttpResponseNotFound('unknown block')
+
+        if wire.accepts(request):
+            return HttpResponse(wire.encode_block(block), content_type=wire.CONTENT_TYPE)
+
+        return JsonResponse({'block': block.dump_sendable(), 'index': block.index})
+
+
+class GetBlockTransactions(View):
+    '''
+    Return transactions at `?positions=` (comma separated) of block with hash `block_hash`,
+    used to complete compact blocks
+    '''
+    def get(self, request, block_hash):
+        block = state.snapshot.block(block_hash)
+        if block is None:
+            return HttpResponseNotFound('unknown block')
+
+        try:
+            positions = [int(pos) for pos in request.GET.get('positions', '').split(',') if pos]
+            transactions = [block.transactions[pos] for pos in positions if pos >= 0]
+        except (ValueError, IndexError):
+            return HttpResponseBadRequest('invalid positions')
+
+        return JsonResponse({'transactions': transactions})
+
+
+class GetTransaction(View):
+    '''
+    Return transaction with id `tx_id`, along with the block it is in
+    '''
+    def get(self, request, tx_id):
+        found = state.snapshot.transaction(tx_id)
+        if found is None:
+            return HttpResponseNotFound('unknown transaction')
+
+        block, pos = found
+        return JsonResponse({
+            'transaction': block.transactions[pos],
+            'block_index': block.index,
+            'block_hash': block.current_hash,
+            'position': pos
+        })
+
+
+class GetHistory(View):
+    '''
+    Return list of transactions sent or received by participant with id `participant`,
+    oldest first
+    '''
+    def get(self, request, participant):
+        snapshot = state.snapshot
+        for pubkey, p in snapshot.participants.items():
+            if p['id'] == participant:
+                break
+        else:
+            return HttpResponseNotFound('unknown participant')
+
+        result = []
+        for block, pos in snapshot.history(pubkey):
+            result.append(dict(transaction_summary(snapshot, block.parsed_transactions()[pos]), block_index=block.index))
+
+        return JsonResponse({'transactions': result})
 
 
 class GetBlockchainLength(View):
@@ -81,11 +257,10 @@ class GetBlockchainLength(View):
     Return current blockchain length
     '''
     def get(self, request):
-        with state.blockchain_public_lock:
-            # DISCUSS: we do not include the genesis block
-            return JsonResponse({
-                'blockchain_length': len(state.blockchain_public)
-            })
+        # DISCUSS: we do not include the genesis block
+        return JsonResponse({
+            'blockchain_length': max(state.snapshot.height - 1, 0)
+        })
 
 
 class GetBalance(View):
@@ -98,18 +273,19 @@ class GetBalance(View):
         }
     }
 
-    It merely sums the amount of validated utxos for each user
+    It reads the running balance of validated utxos for each user
     '''
+    @cached
     def get(self, request):
-        with state.lock:
-            result = {}
-            for pubkey in state.participants:
-                result[state.participants[pubkey]['id']] = {
-                    'host': state.participants[pubkey]['host'],
-                    'pubkey': pubkey,
-                    'amount': sum(x['amount'] for x in state.valid_utxos[pubkey]),
-                    'this': state.participant_id == state.participants[pubkey]['id']
-                }
+        snapshot = state.snapshot
+        result = {}
+        for pubkey, participant in snapshot.participants.items():
+            result[participant['id']] = {
+                'host': participant['host'],
+                'pubkey': pubkey,
+                'amount': snapshot.valid_balances[pubkey],
+                'this': snapshot.participant_id == participant['id']
+            }
 
         return JsonResponse(result)
 
@@ -124,38 +300,40 @@ class GetLatestBalance(View):
         }
     }
 
-    It merely sums the amount of validated utxos for each user
+    It reads the running balance of utxos for each user
     '''
+    @cached
     def get(self, request):
-        with state.lock:
-            result = {}
-            for pubkey in state.participants:
-                result[state.participants[pubkey]['id']] = {
-                    'host': state.participants[pubkey]['host'],
-                    'pubkey': pubkey,
-                    'amount': sum(x['amount'] for x in state.utxos[pubkey]),
-                    'this': state.participant_id == state.participants[pubkey]['id']
-                }
+        snapshot = state.snapshot
+        result = {}
+        for pubkey, participant in snapshot.participants.items():
+            result[participant['id']] = {
+                'host': participant['host'],
+                'pubkey': pubkey,
+                'amount': snapshot.balances[pubkey],
+                'this': snapshot.participant_id == participant['id']
+            }
 
         return JsonResponse(result)
 
 
+def transaction_summary(snapshot, tx):
+    return {
+        'sender_id': snapshot.participants[tx.sender]['id'],
+        'recepient_id': snapshot.participants[tx.recepient]['id'],
+        'id': tx.id,
+        'amount': tx.amount
+    }
+
+
 class GetTransactions(View):
     '''
     Return list of transactions from last block
     '''
+    @cached
     def get(self, request):
-        with state.lock:
-            result = []
-            for tx_json_string in state.blockchain[-1].transactions:
-                tx = Transaction(**json.loads(tx_json_string))
-
-                result.append({
-                    'sender_id': state.participants[tx.sender]['id'],
-                    'recepient_id': state.participants[tx.recepient]['id'],
-                    'id': tx.id,
-                    'amount': tx.amount
-                })
+        snapshot = state.snapshot
+        result = [transaction_summary(snapshot, tx) for tx in snapshot.blocks()[-1].parsed_transactions()]
 
         return JsonResponse({'transactions': result})
 
@@ -164,43 +342,33 @@ class GetAllTransactions(View):
     '''
     Return list of transactions from all blocks
     '''
+    @cached
     def get(self, request):
-        with state.lock:
-            blocks = []
-            for block in state.blockchain:
-                txs = []
-                for tx_json_string in block.transactions:
-                    tx = Transaction(**json.loads(tx_json_string))
-
-                    txs.append({
-                        'sender_id': state.participants[tx.sender]['id'],
-                        'recepient_id': state.participants[tx.recepient]['id'],
-                        'id': tx.id,
-                        'amount': tx.amount
-                    })
-
-                blocks.append({
-                    'index': block.index,
-                    'transactions': txs,
-                    'hash': block.current_hash,
-                    'prev': block.previous_hash
-                })
-
-            # txs = []
-            # for tx in state.transactions:
-            #     txs.append({
-            #         'sender_id': state.participants[tx.sender]['id'],
-            #         'sender': tx.sender,
-            #         'recepient_id': state.participants[tx.recepient]['id'],
-            #         'recepient': tx.recepient,
-            #         'amount': tx.amount
-            #     })
-
-            # if txs:
-            #     blocks.append({
-            #         'index': 'pending',
-            #         'transactions': txs
-            #     })
+        snapshot = state.snapshot
+        blocks = []
+        for block in snapshot.blocks():
+            blocks.append({
+                'index': block.index,
+                'transactions': [transaction_summary(snapshot, tx) for tx in block.parsed_transactions()],
+                'hash': block.current_hash,
+                'prev': block.previous_hash
+            })
+
+        # txs = []
+        # for tx in state.transactions:
+        #     txs.append({
+        #         'sender_id': state.participants[tx.sender]['id'],
+        #         'sender': tx.sender,
+        #         'recepient_id': state.participants[tx.recepient]['id'],
+        #         'recepient': tx.recepient,
+        #         'amount': tx.amount
+        #     })
+
+        # if txs:
+        #     blocks.append({
+        #         'index': 'pending',
+        #         'transactions': txs
+        #     })
 
         return JsonResponse({'blocks': blocks})
 
@@ -209,21 +377,151 @@ class GetTotalBlocksCreated(View):
     Return how many blocks this node has created (including the ones dropped by consensus)
     '''
     def get(self, request):
-        with state.lock:
-            return JsonResponse({'num_blocks': state.num_blocks_created})
+        return JsonResponse({'num_blocks': state.snapshot.num_blocks_created})
 
 class GetNumPendingTransactions(View):
     '''
     Return how many pending transactions have not yet been mined
     '''
     def get(self, request):
-        with state.lock:
-            return JsonResponse({'num_pending': len(state.transactions)})
+        return JsonResponse({'num_pending': state.snapshot.num_pending})
+
+class GetPeerStats(View):
+    '''
+    Return broadcast statistics for each peer (messages sent, failed, dropped, latency)
+    '''
+    def get(self, request):
+        return JsonResponse({'peers': broadcast.stats()})
 
 class GetPendingTransactions(View):
     '''
     Return list of pending transactions
     '''
+    @cached
     def get(self, request):
-        with state.lock:
-            return JsonResponse({'transactions': json.dumps([tx.dump_sendable() for tx in state.transactions])})
+        return JsonResponse({'transactions': json.dumps([tx.dump_sendable() for tx in state.snapshot.pending()])})
+
+
+class GetMetrics(View):
+    '''
+    Return metrics in the Prometheus text format: timings of the hot paths, the state lock
+    and broadcasts, chain height, mempool size, utxos and miner hashes
+    '''
+    def get(self, request):
+        return HttpResponse(metrics.export(), content_type='text/plain; version=0.0.4')
+
+
+def read_events_request(request):
+    '''@return (since, since_height, timeout) of an `events/` request, raises ValueError'''
+    since = request.GET.get('since', request.META.get('HTTP_LAST_EVENT_ID'))
+    since_height = request.GET.get('since_height')
+    timeout = float(request.GET.get('timeout', settings.EVENTS_TIMEOUT))
+
+    return (
+        int(since) if since is not None else None,
+        int(since_height) if since_height is not None else None,
+        min(max(timeout, 0), settings.EVENTS_TIMEOUT)
+    )
+
+
+def _with_reset(found, last_id, snapshot):
+    '''
+    some events were lost, or the subscriber asked for events we never sent (e.g. before
+    a restart): prepend a reset event, the subscriber should ask for the state again.
+    its id comes right before the `found` events, or is `last_id` (read before looking
+    for them), so the subscriber carries on from there
+    '''
+    reset_id = found[0]['id'] - 1 if found else last_id
+    return [{'id': reset_id, 'type': 'reset', 'height': max(snapshot.height - 1, 0)}] + found
+
+
+def first_events(since, since_height):
+    '''
+    events a subscriber gets right away: a block event for each block after `since_height`,
+    and the events after event id `since`. without `since`, the feed starts now.
+
+    @return (events, id of the last event seen)
+    '''
+    # read the event id first, so that nothing in between is missed (it may be repeated)
+    last_id = events.last_id()
+    event_id = last_id if since is None else since
+    snapshot = state.snapshot
+
+    found = []
+    if since_height is not None:
+        found.extend({
+            'id': min(event_id, last_id),
+            'type': 'block',
+            'height': block.index,
+            'hash': block.current_hash,
+            'transactions': len(block.transactions)
+        } for block in snapshot.blocks(max(since_height + 1, 1)))
+
+    if since is not None:
+        new, complete = events.since(since)
+        if not complete:
+            new = _with_reset(new, last_id, snapshot)
+
+        found.extend(new)
+        if new:
+            event_id = new[-1]['id']
+
+    return found, event_id
+
+
+def poll_events(since, since_height, timeout):
+    '''long-poll: wait up to `timeout` seconds for events. @return response of `events/`'''
+    found, event_id = first_events(since, since_height)
+    if not found:
+        last_id = events.last_id()
+        found, complete = events.wait(event_id, timeout)
+        if not complete:
+            found = _with_reset(found, last_id, state.snapshot)
+
+    if found:
+        event_id = found[-1]['id']
+
+    return {'events': found, 'last_id': event_id}
+
+
+def stream_events(since, since_height):
+    '''server-sent events, forever. a comment is sent when nothing happens for EVENTS_TIMEOUT seconds'''
+    found, event_id = first_events(since, since_height)
+    while True:
+        for event in found:
+            yield f'id: {event["id"]}\nevent: {event["type"]}\ndata: {json.dumps(event)}\n\n'.encode()
+            event_id = event['id']
+
+        if not found:
+            yield b': keep-alive\n\n'
+
+        last_id = events.last_id()
+        found, complete = events.wait(event_id, settings.EVENTS_TIMEOUT)
+        if not complete:
+            found = _with_reset(found, last_id, state.snapshot)
+
+
+class GetEvents(View):
+    '''
+    Feed of new blocks (`block`), accepted transactions (`transaction`) and adopted
+    forks (`fork`, followed by the new blocks). Each event has an increasing `id`.
+
+    With `Accept: text/event-stream`, events are streamed as server-sent events.
+    Otherwise, long-poll: wait up to `?timeout=` seconds for events after event id
+    `?since=`, @return {'events': [...], 'last_id': id to ask for next}.
+
+    `?since_height=` first sends a block event for each block after that height.
+    An event of type `reset` means that some events were lost, ask for the state again.
+    '''
+    def get(self, request):
+        try:
+            since, since_height, timeout = read_events_request(request)
+        except ValueError:
+            return HttpResponseBadRequest('invalid since, since_height or timeout')
+
+        if EVENT_STREAM_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+            response = StreamingHttpResponse(stream_events(since, since_height), content_type=EVENT_STREAM_CONTENT_TYPE)
+            response['Cache-Control'] = 'no-cache'
+            return response
+
+        return JsonResponse(poll_events(since, since_height, timeout))
@@ -0,0 +1,327 @@
+# wire.py
+# Compact binary encoding of transactions and blocks
+
+import json
+import base64
+import struct
+
+from noobcash.backend import state, settings
+from noobcash.backend.transaction import Transaction
+
+################################################################################
+
+# Content type of binary messages. Peers opt in by sending it as `Content-Type`
+# (receive_transaction/, receive_block/, receive_compact_block/) or `Accept` (get_blockchain/, get_block/)
+CONTENT_TYPE = 'application/x-noobcash'
+
+# Hashes are hex strings of SHA384, sent as raw bytes
+HASH_SIZE = 48
+
+# transaction (big endian):
+#     H       sender id
+#     H       recepient id
+#     B       amount type (0: int, 1: float)
+#     q/d     amount
+#     48s     id
+#     H, ...  signature length, signature (raw bytes)
+#     H, ...  number of inputs, input ids (48s each)
+#
+# block:
+#     H, ...  timestamp length, timestamp (utf-8)
+#     Q       nonce
+#     48s     current hash
+#     48s     previous hash
+#     H, ...  number of transactions, then for each one: I length, transaction
+#
+# list of blocks (get_blockchain/):
+#     I, ...  number of blocks, then for each one: I length, block
+#
+# list of transactions (receive_transactions/):
+#     I, ...  number of transactions, then for each one: I length, transaction
+#
+# compact block (receive_compact_block/):
+#     H       id of the sending participant, who has all the transactions
+#     H, ...  timestamp length, timestamp (utf-8)
+#     Q       nonce
+#     48s     current hash
+#     48s     previous hash
+#     H, ...  number of transactions, transaction ids (48s each)
+
+_TX_HEADER = struct.Struct('>HHB')
+_BLOCK_HEADER = struct.Struct('>Q48s48s')
+
+
+def _pubkeys():
+    '''participant public keys, by id'''
+    return {p['id']: pubkey for pubkey, p in state.participants.items()}
+
+
+class _Reader(object):
+    '''read values from a binary message'''
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def read(self, length):
+        if self.offset + length > len(self.data):
+            raise ValueError('message too short')
+
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def done(self):
+        if self.offset != len(self.data):
+            raise ValueError('trailing bytes in message')
+
+################################################################################
+
+def encode_transaction(t):
+    parts = [_TX_HEADER.pack(
+        state.participants[t.sender]['id'],
+        state.participants[t.recepient]['id'],
+        0 if isinstance(t.amount, int) else 1
+    )]
+    parts.append(struct.pack('>q' if isinstance(t.amount, int) else '>d', t.amount))
+    parts.append(bytes.fromhex(t.id))
+
+    signature = base64.b64decode(t.signature)
+    parts.append(struct.pack('>H', len(signature)))
+    parts.append(signature)
+
+    parts.append(struct.pack('>H', len(t.inputs)))
+    parts.extend(bytes.fromhex(txin_id) for txin_id in t.inputs)
+
+    return b''.join(parts)
+
+
+def _read_transaction(reader, pubkeys):
+    sender, recepient, amount_type = reader.unpack(_TX_HEADER.format)
+    amount, = reader.unpack('>q' if amount_type == 0 else '>d')
+    id = reader.read(HASH_SIZE).hex()
+
+    length, = reader.unpack('>H')
+    signature = base64.b64encode(reader.read(length)).decode()
+
+    count, = reader.unpack('>H')
+    inputs = [reader.read(HASH_SIZE).hex() for _ in range(count)]
+
+    return Transaction(
+        sender=pubkeys[sender],
+        recepient=pubkeys[recepient],
+        amount=amount,
+        inputs=inputs,
+        id=id,
+        signature=signature
+    )
+
+
+def decode_transaction(data):
+    '''@return Transaction. raises an Exception for invalid messages'''
+    reader = _Reader(data)
+    t = _read_transaction(reader, _pubkeys())
+    reader.done()
+
+    return t
+
+
+def encode_transactions(transactions):
+    parts = [struct.pack('>I', len(transactions))]
+    for t in transactions:
+        data = encode_transaction(t)
+        parts.append(struct.pack('>I', len(data)))
+        parts.append(data)
+
+    return b''.join(parts)
+
+
+def decode_transactions(data):
+    '''@return list of Transaction'''
+    pubkeys = _pubkeys()
+    reader = _Reader(data)
+
+    transactions = []
+    count, = reader.unpack('>I')
+    for _ in range(count):
+        length, = reader.unpack('>I')
+        tx_reader = _Reader(reader.read(length))
+        transactions.append(_read_transaction(tx_reader, pubkeys))
+        tx_reader.done()
+
+    reader.done()
+    return transactions
+
+
+def encode_block(block):
+    timestamp = block.timestamp.encode()
+    parts = [struct.pack('>H', len(timestamp)), timestamp]
+    parts.append(_BLOCK_HEADER.pack(
+        block.nonce,
+        bytes.fromhex(block.current_hash),
+        bytes.fromhex(block.previous_hash)
+    ))
+
+    parts.append(struct.pack('>H', len(block.transactions)))
+    for tx_json in block.transactions:
+        tx = encode_transaction(Transaction(**json.loads(tx_json)))
+        parts.append(struct.pack('>I', len(tx)))
+        parts.append(tx)
+
+    return b''.join(parts)
+
+
+def _read_block(reader, pubkeys):
+    length, = reader.unpack('>H')
+    timestamp = reader.read(length).decode()
+    nonce, current_hash, previous_hash = reader.unpack(_BLOCK_HEADER.format)
+
+    transactions = []
+    count, = reader.unpack('>H')
+    for _ in range(count):
+        length, = reader.unpack('>I')
+        tx_reader = _Reader(reader.read(length))
+        transactions.append(_read_transaction(tx_reader, pubkeys).dump_sendable())
+        tx_reader.done()
+
+    return dict(
+        timestamp=timestamp,
+        transactions=transactions,
+        nonce=nonce,
+        current_hash=current_hash.hex(),
+        previous_hash=previous_hash.hex()
+    )
+
+
+def decode_block(data):
+    '''@return dict of block fields, same as the sendable json. raises an Exception for invalid messages'''
+    reader = _Reader(data)
+    block = _read_block(reader, _pubkeys())
+    reader.done()
+
+    return block
+
+
+def encode_blocks(blocks):
+    parts = [struct.pack('>I', len(blocks))]
+    for block in blocks:
+        data = encode_block(block)
+        parts.append(struct.pack('>I', len(data)))
+        parts.append(data)
+
+    return b''.join(parts)
+
+
+def decode_blocks(data):
+    '''@return list of dicts of block fields'''
+    pubkeys = _pubkeys()
+    reader = _Reader(data)
+
+    blocks = []
+    count, = reader.unpack('>I')
+    for _ in range(count):
+        length, = reader.unpack('>I')
+        block_reader = _Reader(reader.read(length))
+        blocks.append(_read_block(block_reader, pubkeys))
+        block_reader.done()
+
+    reader.done()
+    return blocks
+
+def compact_block(block):
+    '''
+    @return dict of the block fields, with transaction ids instead of transactions,
+    and the id of this participant (who has the transactions)
+    '''
+    return dict(
+        participant_id=state.participant_id,
+        timestamp=block.timestamp,
+        nonce=block.nonce,
+        current_hash=block.current_hash,
+        previous_hash=block.previous_hash,
+        tx_ids=[t.id for t in block.parsed_transactions()]
+    )
+
+
+def encode_compact_block(block):
+    timestamp = block.timestamp.encode()
+    parts = [struct.pack('>HH', state.participant_id, len(timestamp)), timestamp]
+    parts.append(_BLOCK_HEADER.pack(
+        block.nonce,
+        bytes.fromhex(block.current_hash),
+        bytes.fromhex(block.previous_hash)
+    ))
+
+    parts.append(struct.pack('>H', len(block.transactions)))
+    parts.extend(bytes.fromhex(t.id) for t in block.parsed_transactions())
+
+    return b''.join(parts)
+
+
+def decode_compact_block(data):
+    '''@return dict of compact block fields, same as `compact_block()`'''
+    reader = _Reader(data)
+    participant_id, length = reader.unpack('>HH')
+    timestamp = reader.read(length).decode()
+    nonce, current_hash, previous_hash = reader.unpack(_BLOCK_HEADER.format)
+
+    count, = reader.unpack('>H')
+    tx_ids = [reader.read(HASH_SIZE).hex() for _ in range(count)]
+    reader.done()
+
+    return dict(
+        participant_id=participant_id,
+        timestamp=timestamp,
+        nonce=nonce,
+        current_hash=current_hash.hex(),
+        previous_hash=previous_hash.hex(),
+        tx_ids=tx_ids
+    )
+
+################################################################################
+
+def transaction_message(t):
+    '''message for `receive_transaction/`, in the configured wire format'''
+    if settings.WIRE_FORMAT == 'binary':
+        return encode_transaction(t)
+
+    return {'transaction': t.dump_sendable()}
+
+
+def transactions_message(transactions):
+    '''message for `receive_transactions/`, in the configured wire format'''
+    if settings.WIRE_FORMAT == 'binary':
+        return encode_transactions(transactions)
+
+    return {'transactions': json.dumps([t.dump_sendable() for t in transactions])}
+
+
+def block_message(block):
+    '''message for `receive_block/`, in the configured wire format'''
+    if settings.WIRE_FORMAT == 'binary':
+        return encode_block(block)
+
+    return {'block': block.dump_sendable()}
+
+
+def compact_block_message(block):
+    '''message for `receive_compact_block/`, in the configured wire format'''
+    if settings.WIRE_FORMAT == 'binary':
+        return encode_compact_block(block)
+
+    return {'block': json.dumps(compact_block(block))}
+
+
+def accepts(request):
+    '''True if the peer making `request` asked for binary responses'''
+    return CONTENT_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+
+def is_binary(request):
+    '''True if the body of `request` is binary'''
+    return request.content_type == CONTENT_TYPE
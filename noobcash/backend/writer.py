@@ -0,0 +1,181 @@
+# writer.py
+# Single writer of the global state, readers use immutable snapshots
+
+import queue
+import threading
+
+from concurrent.futures import Future
+
+from noobcash.backend import state, metrics, events
+from noobcash.backend.block import MAX_TARGET
+
+
+class Snapshot(object):
+    '''
+    Read-only copy of the state, as of the end of the last change. Published by the
+    writer in `state.snapshot`, readers get it without locking.
+
+    `blockchain` and `blockchain_public` are the lists of the state. They are only
+    appended to (a new list is created when a fork is adopted), so each snapshot
+    only looks at the first `height` blocks. Same for `index`, a new one is created
+    when a fork is adopted.
+
+    Same for pending transactions: `pending_log` is the log of the mempool, only
+    appended to (see `Mempool`), and each snapshot only looks at its first `num_pending`
+    transactions. Nothing is copied when a snapshot is published.
+
+    `version` goes up whenever the chain, the pending transactions or the participants
+    change, so readers can cache what they compute from a snapshot.
+    '''
+    __slots__ = (
+        'height', 'blockchain', 'blockchain_public', 'index', 'participants', 'participant_id',
+        'balances', 'valid_balances', 'mempool', 'pending_log', 'num_pending', 'mempool_version',
+        'num_utxos', 'num_blocks_created', 'version'
+    )
+
+    def __init__(self):
+        self.height = len(state.blockchain)
+        self.blockchain = state.blockchain
+        self.blockchain_public = state.blockchain_public
+        self.index = state.index
+        self.participants = dict(state.participants)
+        self.participant_id = state.participant_id
+        self.balances = {pubkey: state.utxos.balance(pubkey) for pubkey in self.participants}
+        self.valid_balances = {pubkey: state.valid_utxos.balance(pubkey) for pubkey in self.participants}
+        self.mempool = state.transactions
+        self.pending_log = state.transactions.log
+        self.num_pending = len(state.transactions.log)
+        self.mempool_version = state.transactions.version
+        self.num_utxos = len(state.utxos)
+        self.num_blocks_created = state.num_blocks_created
+        self.version = 0
+
+
+    def same_as(self, o):
+        '''same chain, pending transactions and participants as snapshot `o`'''
+        return (self.blockchain is o.blockchain
+            and self.height == o.height
+            and self.mempool_version == o.mempool_version
+            and self.participants == o.participants)
+
+
+    def pending(self):
+        '''pending transactions, oldest first'''
+        return self.pending_log[:self.num_pending]
+
+
+    def pending_transaction(self, tx_id):
+        '''
+        pending transaction `tx_id`, or None. looked up in the mempool itself without
+        locking, so it may have changed since (transactions do not change)
+        '''
+        return self.mempool.get(tx_id)
+
+
+    def blocks(self, start=0, end=None):
+        '''blocks with index `start` up to `end` (or the tip)'''
+        end = self.height if end is None else min(end, self.height)
+        return self.blockchain[start:end]
+
+
+    def public(self, start=1, end=None):
+        '''sendable json bytes of blocks with index `start` up to `end` (or the tip)'''
+        end = self.height if end is None else min(end, self.height)
+        return self.blockchain_public[max(start, 1) - 1:end - 1]
+
+
+    def transaction(self, tx_id):
+        '''@return (block, position in block) of transaction `tx_id`, or None if not in the chain'''
+        found = self.index.transactions.get(tx_id)
+        if found is None or found[0] >= self.height:
+            return None
+
+        return self.blockchain[found[0]], found[1]
+
+
+    def block(self, block_hash):
+        '''@return block with hash `block_hash`, or None'''
+        index = self.index.blocks.get(block_hash)
+        if index is None or index >= self.height:
+            return None
+
+        return self.blockchain[index]
+
+
+    def history(self, pubkey):
+        '''@return list of (block, position) of the transactions sent or received by `pubkey`, oldest first'''
+        result = []
+        for tx_id in list(self.index.history.get(pubkey, ())):
+            found = self.transaction(tx_id)
+            if found is not None:
+                result.append(found)
+
+        return result
+
+
+def publish():
+    with state.lock:
+        snapshot = Snapshot()
+        if state.snapshot is not None:
+            snapshot.version = state.snapshot.version + (not snapshot.same_as(state.snapshot))
+
+        state.snapshot = snapshot
+
+
+metrics.Gauge('noobcash_chain_height', 'Index of the last block', lambda: max(state.snapshot.height - 1, 0))
+metrics.Gauge('noobcash_mempool_size', 'Pending transactions', lambda: state.snapshot.num_pending)
+metrics.Gauge('noobcash_utxos', 'Unspent transaction outputs', lambda: state.snapshot.num_utxos)
+metrics.Gauge('noobcash_difficulty', 'Expected hashes to mine the next block, as of the last block',
+              lambda: MAX_TARGET // state.snapshot.blockchain[state.snapshot.height - 1].target if state.snapshot.height else 0)
+metrics.Counter('noobcash_blocks_created_total', 'Blocks mined by this participant', lambda: state.snapshot.num_blocks_created)
+
+################################################################################
+
+# the writer runs one job at a time, holding `state.lock`. code that still locks the
+# state directly (e.g. the miner) is serialized with it
+_jobs = queue.Queue()
+
+def _run():
+    while True:
+        fn, args, future = _jobs.get()
+        try:
+            with state.lock:
+                try:
+                    result = fn(*args)
+                finally:
+                    publish()
+                    events.flush()
+
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+
+_thread = threading.Thread(target=_run, name='writer', daemon=True)
+_thread.start()
+
+
+def post(fn, *args):
+    '''run `fn(*args)` on the writer thread. @return a Future for the result'''
+    future = Future()
+    if threading.current_thread() is _thread:
+        future.set_result(fn(*args))
+    else:
+        _jobs.put((fn, args, future))
+
+    return future
+
+
+def submit(fn, *args):
+    '''
+    run `fn(*args)` on the writer thread and wait for it.
+    @return the result of `fn`, or raise its exception
+    '''
+    if threading.current_thread() is _thread:
+        return fn(*args)
+
+    return post(fn, *args).result()
+
+
+publish()
@@ -0,0 +1,7 @@
+"""
+Django settings for running noobcash under ASGI, see `asgi.py`
+"""
+
+from noobcash.settings import *
+
+ROOT_URLCONF = 'noobcash.urls_async'
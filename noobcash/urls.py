@@ -27,6 +27,11 @@ urlpatterns = [
     # get information
     path('get_blockchain/', GetBlockchain.as_view()),
     path('get_blockchain_length/', GetBlockchainLength.as_view()),
+    path('get_headers/', GetHeaders.as_view()),
+    path('get_block/<str:block_id>/', GetBlock.as_view()),
+    path('get_block_transactions/<str:block_hash>/', GetBlockTransactions.as_view()),
+    path('get_transaction/<str:tx_id>/', GetTransaction.as_view()),
+    path('get_history/<int:participant>/', GetHistory.as_view()),
     path('get_balance/', GetBalance.as_view()),
     path('get_balance_latest/', GetLatestBalance.as_view()),
     path('get_transactions/', GetTransactions.as_view()),
@@ -34,12 +39,18 @@ urlpatterns = [
     path('get_num_blocks_created/', GetTotalBlocksCreated.as_view()),
     path('get_num_pending_transactions/', GetNumPendingTransactions.as_view()),
     path('get_pending_transactions/', GetPendingTransactions.as_view()),
+    path('get_peer_stats/', GetPeerStats.as_view()),
+    path('metrics/', GetMetrics.as_view()),
+    path('events/', GetEvents.as_view()),
 
     # receive
     path('receive_transaction/', ReceiveTransaction.as_view()),
+    path('receive_transactions/', ReceiveTransactions.as_view()),
     path('receive_block/', ReceiveBlock.as_view()),
+    path('receive_compact_block/', ReceiveCompactBlock.as_view()),
+    path('inv/', ReceiveInventory.as_view()),
 
     # send
     path('create_transaction/', CreateAndSendTransaction.as_view()),
-    path('create_block/', CreateAndSendBlock.as_view())
+    path('create_transactions/', CreateAndSendTransactions.as_view()),
 ]
@@ -0,0 +1,47 @@
+"""noobcash URL Configuration for ASGI (see `asgi.py`)
+
+Same endpoints as `urls.py`. Peer and client endpoints are async views, connecting
+(once, at startup) still uses the sync views, each request in a thread of its own.
+"""
+from django.urls import path
+
+from noobcash.backend.views import InitAsServer, InitAsClient, ClientConnect, ClientAccepted
+from noobcash.backend.views import aio
+
+urlpatterns = [
+    # connections
+    path('init_server/', aio.in_thread(InitAsServer)),
+    path('init_client/', aio.in_thread(InitAsClient)),
+    path('client_connect/', aio.in_thread(ClientConnect)),
+    path('client_accepted/', aio.in_thread(ClientAccepted)),
+
+    # get information
+    path('get_blockchain/', aio.get_blockchain),
+    path('get_blockchain_length/', aio.get_blockchain_length),
+    path('get_headers/', aio.get_headers),
+    path('get_block/<str:block_id>/', aio.get_block),
+    path('get_block_transactions/<str:block_hash>/', aio.get_block_transactions),
+    path('get_transaction/<str:tx_id>/', aio.get_transaction),
+    path('get_history/<int:participant>/', aio.get_history),
+    path('get_balance/', aio.get_balance),
+    path('get_balance_latest/', aio.get_balance_latest),
+    path('get_transactions/', aio.get_transactions),
+    path('get_transactions_all/', aio.get_transactions_all),
+    path('get_num_blocks_created/', aio.get_num_blocks_created),
+    path('get_num_pending_transactions/', aio.get_num_pending_transactions),
+    path('get_pending_transactions/', aio.get_pending_transactions),
+    path('get_peer_stats/', aio.get_peer_stats),
+    path('metrics/', aio.get_metrics),
+    path('events/', aio.get_events),
+
+    # receive
+    path('receive_transaction/', aio.receive_transaction),
+    path('receive_transactions/', aio.receive_transactions),
+    path('receive_block/', aio.receive_block),
+    path('receive_compact_block/', aio.receive_compact_block),
+    path('inv/', aio.receive_inventory),
+
+    # send
+    path('create_transaction/', aio.create_transaction),
+    path('create_transactions/', aio.create_transactions),
+]
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'noobcash.settings')
 
 application = get_wsgi_application()
+
+# `runserver` loads this in the process that serves requests
+from noobcash.backend.apps import start
+start()
@@ -12,6 +12,10 @@ setup(
     url='https://github.com/neoaggelos/noobcash',
     author='Aggelos Kolaitis',
     install_requires=[
-        'Django', 'pycrypto', 'requests'
-    ]
+        'Django>=3.1', 'pycrypto', 'requests'
+    ],
+    extras_require={
+        # async views, see noobcash/asgi.py
+        'asgi': ['uvicorn', 'httpx']
+    }
 )